@@ -1,30 +1,48 @@
 import os
 import re
-import cv2
 import numpy as np
-import pandas as pd
-from doctr.io import DocumentFile
-from doctr.models import ocr_predictor
 import sys
 import math
+import time
 import json
 import difflib
-import easyocr
-from pdf2image import convert_from_path
-from firebase_service import FirebaseService
+import threading
+import copy
+import shutil
+import io
+import tempfile
+import uuid
+from metrics import METRICS
+from tracing import log, setup_logging, start_trace, NULL_TRACE
+from layout_templates import LayoutTemplateStore
+from sync_manifest import file_sha256, write_json_atomic
+from reference_ranges import flag_value, add_flags
+from patient_shards import export_shards
+from result_records import ResultRecord, as_records, records_to_frame
+
+# Heavy backends (cv2, docTR/torch, EasyOCR, pdf2image, pandas, firebase_admin)
+# are imported inside the stages that use them, so importing this module for
+# the pure helpers stays cheap. Use RobustOCR.warm_up() to load models up front.
+
+# Bump when extraction output changes so incremental runs reprocess old files
+PIPELINE_VERSION = "4"
 
 # ================= PATH CONFIGURATION =================
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 INPUT_DIR = os.path.join(BASE_DIR, "input")
 OUTPUT_DIR = os.path.join(BASE_DIR, "output")
 LOGS_DIR = os.path.join(BASE_DIR, "logs")
+SCRATCH_DIR = os.path.join(LOGS_DIR, "scratch") # Per-document page images, removed after each run
+MASTER_JSON = os.environ.get("OCR_MASTER_JSON", "1") != "0" # Single-file JSON next to the per-patient shards
 
-# Ensure directories exist
-os.makedirs(INPUT_DIR, exist_ok=True)
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-os.makedirs(LOGS_DIR, exist_ok=True)
-
-DEBUG_FILE = os.path.join(LOGS_DIR, "debug_info.txt")
+def ensure_dirs():
+    """
+    Creates input/output/logs/scratch on first use instead of at import time.
+    """
+    os.makedirs(INPUT_DIR, exist_ok=True)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    os.makedirs(SCRATCH_DIR, exist_ok=True)
 
 # ================= PATIENT MANAGEMENT =================
 
@@ -39,6 +57,8 @@ class PatientManager:
         else:
             self.registry_path = registry_path
             
+        # Shared across request threads: guards patient_map, next_id and the file
+        self.lock = threading.RLock()
         self.patient_map = self.load_registry() # { "normalized_name": "ID" }
         self.next_id = self.calculate_next_id()
 
@@ -48,19 +68,19 @@ class PatientManager:
                 with open(self.registry_path, "r", encoding="utf-8") as f:
                     return json.load(f)
             except Exception as e:
-                print(f"Warning: Could not load registry: {e}")
+                log.warning("Could not load registry: %s", e)
                 return {}
         return {}
 
     def save_registry(self):
         try:
             os.makedirs(os.path.dirname(self.registry_path), exist_ok=True)
-            print(f"DEBUG: Attempting to save registry to {self.registry_path}")
-            with open(self.registry_path, "w", encoding="utf-8") as f:
-                json.dump(self.patient_map, f, indent=4)
-            print(f"Registry saved to {self.registry_path}")
+            log.debug("Attempting to save registry to %s", self.registry_path)
+            with self.lock:
+                write_json_atomic(self.registry_path, self.patient_map, indent=4)
+            log.info("Registry saved to %s", self.registry_path)
         except Exception as e:
-            print(f"Error saving registry: {e}")
+            log.error("Error saving registry: %s", e)
 
     def calculate_next_id(self):
         if not self.patient_map:
@@ -97,16 +117,17 @@ class PatientManager:
         if normalized == "UNKNOWN" or not normalized:
             return "UNKNOWN", "UNKNOWN"
 
-        if normalized in self.patient_map:
-            return self.patient_map[normalized], normalized
-        
-        # Create new ID
-        new_id = str(self.next_id)
-        self.patient_map[normalized] = new_id
-        self.next_id += 1
-        
-        # Auto-save on creation (optional, but safer)
-        self.save_registry()
+        with self.lock:
+            if normalized in self.patient_map:
+                return self.patient_map[normalized], normalized
+            
+            # Create new ID
+            new_id = str(self.next_id)
+            self.patient_map[normalized] = new_id
+            self.next_id += 1
+            
+            # Auto-save on creation (optional, but safer)
+            self.save_registry()
         
         return new_id, normalized
 
@@ -228,28 +249,8 @@ def standardize_name(name):
             
     return name.upper()
 
-def get_flag(value, ref_range):
-    if not ref_range or not value: return "Unknown"
-    
-    # Simple check for Positive/Negative
-    if "negative" in value.lower() or "non-reactive" in value.lower():
-        return "NEGATIVE"
-    if "positive" in value.lower() or "reactive" in value.lower():
-        return "POSITIVE"
-        
-    try:
-        val_float = float(re.search(r'\d+(\.\d+)?', value).group())
-        # Parse range "X - Y"
-        range_nums = re.findall(r'\d+(\.\d+)?', ref_range)
-        if len(range_nums) >= 2:
-            low = float(range_nums[0][0] if isinstance(range_nums[0], tuple) else range_nums[0])
-            high = float(range_nums[-1][0] if isinstance(range_nums[-1], tuple) else range_nums[-1])
-            if val_float < low: return "Low"
-            if val_float > high: return "High"
-            return "Normal"
-    except:
-        pass
-    return "Normal"
+def get_flag(value, ref_range, sex=None):
+    return flag_value(value, ref_range, sex)
 
 def calculate_confidence(ocr_conf, unit, ref_range, value):
     score = 0.4 * ocr_conf
@@ -258,14 +259,490 @@ def calculate_confidence(ocr_conf, unit, ref_range, value):
     if value: score += 0.2
     return round(score * 100, 2)
 
+def iter_lines(words, tol=0.015):
+    """
+    Sorts words top-to-bottom and yields them grouped into rough lines.
+    A word joins the current line if its top is within tol (relative page height,
+    1.5% tuned) of the previous word's top. Lazy, so callers that stop at a
+    footer don't group the rest of the page.
+    """
+    words = sorted(words, key=lambda w: (w.geometry[0][1], w.geometry[0][0]))
+    if words:
+        current_line = [words[0]]
+        for w in words[1:]:
+            if abs(w.geometry[0][1] - current_line[-1].geometry[0][1]) < tol:
+                current_line.append(w)
+            else:
+                yield current_line
+                current_line = [w]
+        yield current_line
+
+def group_lines(words, tol=0.015):
+    return list(iter_lines(words, tol))
+
+def find_content_box(gray, pad=0.01):
+    """
+    Bounding box (x0, y0, x1, y1) of the ink on a grayscale page.
+    Rows/columns that are almost entirely dark (scanner or fax borders) are
+    ignored. Returns the full page when nothing is found.
+    """
+    import cv2
+    h, w = gray.shape
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    ink = cv2.morphologyEx(ink, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8)) # Drop speckle
+    # Blank out solid border lines so they don't count as content
+    ink[:, ink.mean(axis=0) > 0.9] = 0
+    ink[ink.mean(axis=1) > 0.9, :] = 0
+    rows = np.flatnonzero(ink.mean(axis=1) > 0.002)
+    cols = np.flatnonzero(ink.mean(axis=0) > 0.002)
+    if len(rows) == 0 or len(cols) == 0:
+        return 0, 0, w, h
+
+    pad_x, pad_y = int(w * pad), int(h * pad)
+    x0 = max(0, cols[0] - pad_x)
+    y0 = max(0, rows[0] - pad_y)
+    x1 = min(w, cols[-1] + 1 + pad_x)
+    y1 = min(h, rows[-1] + 1 + pad_y)
+    return int(x0), int(y0), int(x1), int(y1)
+
+def preprocess_page(img, crop=True, max_side=None, color="color"):
+    """
+    Crops a BGR page to its content, caps the longest side and optionally
+    converts to grayscale or binarizes it.
+    Returns (processed_img, box) where box = (x0, y0, crop_w, crop_h, page_w, page_h)
+    in original pixels, used by remap_page_geometry to undo the crop.
+    """
+    import cv2
+    h, w = img.shape[:2]
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    x0, y0, x1, y1 = find_content_box(gray) if crop else (0, 0, w, h)
+    box = (x0, y0, x1 - x0, y1 - y0, w, h)
+    out = gray if color in ("gray", "binary") else img
+    out = out[y0:y1, x0:x1]
+
+    if max_side and max(out.shape[:2]) > max_side:
+        scale = max_side / max(out.shape[:2])
+        out = cv2.resize(out, (int(out.shape[1] * scale), int(out.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+
+    if color == "binary":
+        _, out = cv2.threshold(out, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return np.ascontiguousarray(out), box
+
+def is_full_page(box):
+    x0, y0, cw, ch, w, h = box
+    return (x0, y0, cw, ch) == (0, 0, w, h)
+
+def to_page_geometry(geom, box):
+    """
+    Relative geometry on the processed (cropped) image -> relative geometry
+    on the full page.
+    """
+    x0, y0, cw, ch, w, h = box
+    sx, sy, ox, oy = cw / w, ch / h, x0 / w, y0 / h
+    if isinstance(geom, np.ndarray): # Rotated boxes (polygons)
+        return geom * np.array([sx, sy]) + np.array([ox, oy])
+    return tuple((ox + x * sx, oy + y * sy) for x, y in geom)
+
+def to_crop_geometry(geom, box):
+    """
+    Inverse of to_page_geometry for straight boxes: full-page relative
+    geometry -> relative geometry on the processed image (for crop_word).
+    """
+    x0, y0, cw, ch, w, h = box
+    sx, sy, ox, oy = cw / w, ch / h, x0 / w, y0 / h
+    return tuple(((x - ox) / sx, (y - oy) / sy) for x, y in geom)
+
+def remap_page_geometry(page, box):
+    """
+    Maps docTR relative geometry of a cropped page back to the full page,
+    so layout thresholds (header position, column anchors) are unchanged.
+    Downscaling needs no correction since docTR geometry is relative.
+    """
+    if is_full_page(box):
+        return
+    for b in page.blocks:
+        b.geometry = to_page_geometry(b.geometry, box)
+        for l in b.lines:
+            l.geometry = to_page_geometry(l.geometry, box)
+            for word in l.words:
+                word.geometry = to_page_geometry(word.geometry, box)
+        for a in getattr(b, "artefacts", []):
+            a.geometry = to_page_geometry(a.geometry, box)
+    page.dimensions = (box[5], box[4])
+
+# ================= TWO-PHASE OCR =================
+# Minimal stand-ins for docTR's Document/Page/Block/Line/Word, exposing only
+# the attributes the layout code reads.
+
+class OCRWord:
+    __slots__ = ("value", "confidence", "geometry")
+
+    def __init__(self, value, confidence, geometry):
+        self.value = value
+        self.confidence = confidence
+        self.geometry = geometry
+
+class OCRLine:
+    __slots__ = ("geometry", "words")
+
+    def __init__(self, geometry, words):
+        self.geometry = geometry
+        self.words = words
+
+class OCRBlock:
+    __slots__ = ("geometry", "lines", "artefacts")
+
+    def __init__(self, geometry, lines):
+        self.geometry = geometry
+        self.lines = lines
+        self.artefacts = []
+
+class OCRPage:
+    __slots__ = ("blocks", "dimensions")
+
+    def __init__(self, blocks, dimensions):
+        self.blocks = blocks
+        self.dimensions = dimensions
+
+class OCRDocument:
+    __slots__ = ("pages",)
+
+    def __init__(self, pages):
+        self.pages = pages
+
+def detection_boxes(det_output):
+    """
+    Relative (xmin, ymin, xmax, ymax) boxes from one page of docTR detection output.
+    Recent docTR returns {"words": array}, older versions a bare array.
+    """
+    boxes = det_output["words"] if isinstance(det_output, dict) else det_output
+    boxes = np.asarray(boxes)
+    return boxes[:, :4] if len(boxes) else np.zeros((0, 4))
+
+def crop_word(page_img, geometry):
+    """
+    Pixel crop of a relative box, or None if it is empty.
+    """
+    h, w = page_img.shape[:2]
+    (x0, y0), (x1, y1) = geometry
+    x0, y0 = int(max(0.0, x0) * w), int(max(0.0, y0) * h)
+    x1, y1 = int(math.ceil(min(1.0, x1) * w)), int(math.ceil(min(1.0, y1) * h))
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return page_img[y0:y1, x0:x1]
+
+def line_bbox(words):
+    return ((min(w.geometry[0][0] for w in words), min(w.geometry[0][1] for w in words)),
+            (max(w.geometry[1][0] for w in words), max(w.geometry[1][1] for w in words)))
+
+def check_upright(img, max_side=1000, max_skew=2.0):
+    """
+    Cheap OpenCV orientation pre-check.
+    Returns True when the page is confidently upright (horizontal text lines,
+    negligible skew, ascenders above the x-height band), None when undecided.
+    Undecided pages go through docTR's orientation classifier.
+    """
+    import cv2
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape
+    scale = max_side / max(h, w)
+    if scale < 1:
+        gray = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+        h, w = gray.shape
+
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    if ink.mean() < 0.002:
+        return None # Blank page
+
+    # 1. Text lines: smear horizontally vs vertically and count line-shaped blobs
+    def line_blobs(kernel):
+        smeared = cv2.dilate(ink, kernel)
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(smeared, connectivity=8)
+        return labels, stats
+
+    span = max(9, w // 60)
+    h_labels, h_stats = line_blobs(np.ones((1, span), np.uint8))
+    _, v_stats = line_blobs(np.ones((span, 1), np.uint8))
+    # A text line is long (several smear spans) and much longer than it is thick
+    h_idx = np.flatnonzero((h_stats[:, 2] > 4 * span) & (h_stats[:, 2] > 4 * h_stats[:, 3]) & (h_stats[:, 3] > 3))
+    h_idx = h_idx[h_idx > 0] # Drop background
+    v_count = np.count_nonzero((v_stats[1:, 3] > 4 * span) & (v_stats[1:, 3] > 4 * v_stats[1:, 2]) & (v_stats[1:, 2] > 3))
+    if len(h_idx) < 5 or len(h_idx) < 3 * v_count:
+        return None
+
+    # 2. Skew: median angle of the smeared line blobs
+    angles = []
+    for idx in h_idx[:200]:
+        x, y, bw, bh, _ = h_stats[idx]
+        pts = cv2.findNonZero((h_labels[y:y + bh, x:x + bw] == idx).astype(np.uint8))
+        (_, _), (rw, rh), angle = cv2.minAreaRect(pts)
+        if rw < rh: angle -= 90
+        angles.append(((angle + 45) % 90) - 45)
+    if abs(np.median(angles)) > max_skew:
+        return None
+
+    # 3. Upside-down check: ascenders (b, d, h, capitals, digits) make more ink above
+    #    the dense x-height band than descenders (g, p, y) make below it
+    above = below = 0
+    for idx in h_idx:
+        x, y, bw, bh, _ = h_stats[idx]
+        profile = ink[y:y + bh, x:x + bw].sum(axis=1)
+        core = np.flatnonzero(profile >= 0.5 * profile.max())
+        above += profile[:core[0]].sum()
+        below += profile[core[-1] + 1:].sum()
+    if above > 1.2 * below:
+        return True
+    return None
+
+# ================= INFERENCE BACKENDS =================
+# "torch": python-doctr (default)
+# "onnx":  OnnxTR, docTR's models exported to ONNX Runtime (pip install "onnxtr[cpu]").
+#          Returns the same Document -> pages -> blocks -> lines -> words structure
+#          and relative geometry, so the layout code is unchanged.
+OCR_BACKENDS = ("torch", "onnx", "remote") # remote: models live in the shared inference daemon (inference_server.py)
+
+def build_predictor(backend="torch", quantized=False, **kwargs):
+    """
+    Builds a docTR-compatible OCR predictor for the given backend.
+    quantized=True loads the int8 models (ONNX backend only).
+    """
+    if backend == "onnx":
+        try:
+            from onnxtr.models import ocr_predictor
+        except ImportError as e:
+            raise ImportError('The ONNX backend requires OnnxTR: pip install "onnxtr[cpu]"') from e
+        return ocr_predictor(load_in_8_bit=quantized, **kwargs)
+    if backend == "torch":
+        if quantized:
+            log.warning("Quantized models are only available with the ONNX backend; using float32.")
+        from doctr.models import ocr_predictor
+        return ocr_predictor(pretrained=True, **kwargs)
+    if backend == "remote":
+        from inference_server import RemotePredictor, get_client
+        return RemotePredictor(get_client(), kwargs["det_arch"], kwargs["reco_arch"], kwargs.get("detect_orientation", False))
+    raise ValueError(f"Unknown OCR backend '{backend}'. Expected one of {OCR_BACKENDS}")
+
+def load_document_images(image_paths, backend="torch"):
+    """
+    Reads page images with the DocumentFile loader of the given backend.
+    """
+    if backend == "remote":
+        # Plain RGB arrays; keeps docTR/torch out of the worker process
+        import cv2
+        return [cv2.cvtColor(cv2.imread(p), cv2.COLOR_BGR2RGB) for p in image_paths]
+    if backend == "onnx":
+        from onnxtr.io import DocumentFile
+    else:
+        from doctr.io import DocumentFile
+    return DocumentFile.from_images(image_paths)
+
+# ================= IMAGE INGESTION =================
+# Camera photos and scans uploaded directly (JPEG, PNG, multi-frame TIFF ...).
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp", ".webp")
+# A4 long side: a photo gets no more pixels than a scan at the profile's DPI,
+# i.e. a long-side cap of ~2340 px at 200 dpi (balanced/accurate) and ~1755 px at 150 dpi (fast)
+PAGE_LONG_SIDE_INCHES = 11.7
+
+def is_image_file(path):
+    return path.lower().endswith(IMAGE_EXTENSIONS)
+
+def decode_image(data, max_side=None):
+    """
+    Decodes image bytes into BGR pages (one per TIFF frame), applying EXIF
+    orientation and capping the long side at max_side. JPEGs are downscaled
+    during decoding (DCT scaling), so a 12 MP photo is never fully inflated.
+    """
+    from PIL import Image, ImageOps, ImageSequence
+    img = Image.open(io.BytesIO(data))
+    if max_side and img.format == "JPEG":
+        img.draft("RGB", (max_side, max_side))
+    pages = []
+    for frame in ImageSequence.Iterator(img):
+        frame = frame.copy() # Detach from the sequence so thumbnail() can resize in place
+        if max_side and max(frame.size) > max_side:
+            frame.thumbnail((max_side, max_side))
+        frame = ImageOps.exif_transpose(frame).convert("RGB")
+        pages.append(np.array(frame)[:, :, ::-1]) # RGB to BGR
+    return pages
+
+# ================= SPEED / ACCURACY PROFILES =================
+# Each profile bundles the docTR archs, rasterization DPI, orientation handling
+# and name-extraction strategy. "accurate" keeps the original models and
+# orientation handling.
+#
+# name_strategy:
+#   "doctr_first"   - name patterns on the docTR words first; EasyOCR only on the
+#                     name line's bounding box, when nothing matched or the line
+#                     looks like Arabic script (see extract_patient_name)
+#   "easyocr_first" - EasyOCR on the top third of page 1, docTR text as fallback
+#   "doctr_only"    - never run EasyOCR
+#
+# preprocess (see preprocess_page):
+#   crop     - crop to the content bounding box (drops blank margins / fax borders)
+#   max_side - downscale so the longest side is at most this many pixels (None = keep)
+#   color    - "color", "gray" or "binary" (Otsu)
+#
+# two_phase: run docTR detection on every page, then recognition only on the
+# lines needed to find the header, the patient-name region and the table rows
+# up to the footer (see RobustOCR.run_two_phase). Straight pages only, so it is
+# ignored when detect_orientation is on.
+PROFILES = {
+    "fast": {
+        "det_arch": "fast_tiny",
+        "reco_arch": "crnn_mobilenet_v3_small",
+        "dpi": 150,
+        "detect_orientation": False,
+        "name_strategy": "doctr_only",
+        "preprocess": {"crop": True, "max_side": 1600, "color": "gray"},
+        "two_phase": True
+    },
+    "balanced": {
+        "det_arch": "db_mobilenet_v3_large",
+        "reco_arch": "crnn_vgg16_bn",
+        "dpi": 200,
+        "detect_orientation": False,
+        "name_strategy": "doctr_first",
+        "preprocess": {"crop": True, "max_side": 2048, "color": "color"},
+        "two_phase": True
+    },
+    "accurate": {
+        "det_arch": "fast_base",
+        "reco_arch": "crnn_vgg16_bn",
+        "dpi": 200,
+        "detect_orientation": True,
+        "name_strategy": "doctr_first",
+        "preprocess": {"crop": True, "max_side": None, "color": "color"},
+        "two_phase": False
+    }
+}
+DEFAULT_PROFILE = os.environ.get("OCR_PROFILE", "accurate")
+
+def get_profile(name=None):
+    """
+    Returns (name, settings) for a profile name, falling back to DEFAULT_PROFILE.
+    Raises ValueError for unknown names.
+    """
+    name = name or DEFAULT_PROFILE
+    if name not in PROFILES:
+        raise ValueError(f"Unknown profile '{name}'. Expected one of {tuple(PROFILES)}")
+    return name, PROFILES[name]
+
 # ================= ROBUST LOGIC =================
 
+class DocumentContext:
+    """
+    Per-call state of one process_document run: profile, trace and a private
+    scratch directory for page images, so concurrent documents never share
+    files. close() removes the scratch directory and writes the trace.
+    """
+    __slots__ = ("source", "profile_name", "settings", "trace", "scratch_dir")
+
+    def __init__(self, source, profile_name, settings):
+        ensure_dirs()
+        self.source = source
+        self.profile_name = profile_name
+        self.settings = settings
+        self.trace = start_trace(source)
+        self.scratch_dir = tempfile.mkdtemp(prefix="doc_", dir=SCRATCH_DIR)
+
+    def page_path(self, i):
+        return os.path.join(self.scratch_dir, f"page_{i}.png")
+
+    def close(self):
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        self.trace.close()
+
 class RobustOCR:
-    def __init__(self):
+    def __init__(self, backend=None, quantized=None, profile=None, templates=None):
         # Configuration
-        self.column_anchors = {} # { 'Test Name': x_center, 'Result': x_center ... }
-        self.median_line_height = 0.0
+        self.profile, _ = get_profile(profile)
+        # Backend defaults come from OCR_BACKEND / OCR_QUANTIZED
+        self.backend = backend or os.environ.get("OCR_BACKEND", "torch")
+        if quantized is None:
+            quantized = os.environ.get("OCR_QUANTIZED", "0") == "1"
+        self.quantized = quantized
+        if self.backend not in OCR_BACKENDS:
+            raise ValueError(f"Unknown OCR backend '{self.backend}'. Expected one of {OCR_BACKENDS}")
+        # Instances are shared across threads: everything per document lives in a
+        # DocumentContext, only caches and models live here
         self.test_mappings = self.load_test_mappings()
+        self.test_code_cache = {} # { "normalized ocr name": code or None }; single-key writes, no lock needed
+        # Per-lab layout cache; pass templates=False (or OCR_LAYOUT_TEMPLATES=0) to disable
+        if templates is None:
+            templates = os.environ.get("OCR_LAYOUT_TEMPLATES", "1") != "0"
+        if templates is True:
+            templates = LayoutTemplateStore()
+        self.templates = templates or None
+        # Models are loaded on first use (or by warm_up) and reused across documents
+        self.predictors = {} # { profile_name: predictor }
+        self.name_reader = None
+        self.model_lock = threading.Lock()
+
+    def get_predictor(self, profile=None, detect_orientation=None):
+        """
+        Returns the docTR predictor for a profile on the configured backend, loading it on first use.
+        detect_orientation=False returns a variant of an orientation-enabled profile's
+        predictor that shares its models but skips page orientation estimation.
+        """
+        name, settings = get_profile(profile or self.profile)
+        if detect_orientation is False and settings["detect_orientation"]:
+            key = (name, "upright")
+            if key not in self.predictors:
+                base = self.get_predictor(name)
+                with self.model_lock:
+                    if key not in self.predictors:
+                        # Shallow copy: same det/reco models, orientation step off
+                        variant = copy.copy(base)
+                        variant.detect_orientation = False
+                        self.predictors[key] = variant
+            return self.predictors[key]
+
+        if name not in self.predictors:
+            with self.model_lock:
+                if name not in self.predictors:
+                    log.info("Loading %s OCR predictor for profile '%s' (quantized=%s)", self.backend, name, self.quantized)
+                    with METRICS.stage("model_load"):
+                        self.predictors[name] = build_predictor(
+                            self.backend, self.quantized,
+                            det_arch=settings["det_arch"],
+                            reco_arch=settings["reco_arch"],
+                            detect_orientation=settings["detect_orientation"]
+                        )
+        return self.predictors[name]
+
+    def get_name_reader(self):
+        """
+        Returns the EasyOCR reader used for patient names, loading it on first use.
+        """
+        if self.name_reader is None:
+            with self.model_lock:
+                if self.name_reader is None and self.backend == "remote":
+                    from inference_server import RemoteNameReader, get_client
+                    self.name_reader = RemoteNameReader(get_client())
+                elif self.name_reader is None:
+                    import easyocr
+                    with METRICS.stage("model_load"):
+                        self.name_reader = easyocr.Reader(['ar', 'en'], gpu=False) # GPU=False for safety on user machine
+        return self.name_reader
+
+    def warm_up(self, profiles=None):
+        """
+        Loads the models for the given profiles (default: this instance's profile)
+        so the first document doesn't pay for it.
+        """
+        profiles = profiles or [self.profile]
+        log.info("Warming up OCR models for %s...", ", ".join(profiles))
+        for name in profiles:
+            self.get_predictor(name)
+        if any(PROFILES[name]["name_strategy"] != "doctr_only" for name in profiles):
+            self.get_name_reader()
+        log.info("OCR models ready.")
+
+    def is_ready(self):
+        if self.profile not in self.predictors:
+            return False
+        return PROFILES[self.profile]["name_strategy"] == "doctr_only" or self.name_reader is not None
 
     def load_test_mappings(self):
         try:
@@ -273,84 +750,102 @@ class RobustOCR:
             with open(mapping_path, "r", encoding="utf-8") as f:
                 return json.load(f).get("mappings", {})
         except Exception as e:
-            print(f"Warning: Could not load test mappings: {e}")
+            log.warning("Could not load test mappings: %s", e)
             return {}
 
     def get_test_code(self, ocr_name):
         norm_name = ocr_name.lower().strip()
         # Direct match
         if norm_name in self.test_mappings:
+            METRICS.inc("test_code_lookups", result="direct")
             return self.test_mappings[norm_name]
+
+        # Same OCR names repeat across reports; difflib is the expensive part
+        if norm_name in self.test_code_cache:
+            METRICS.inc("test_code_lookups", result="cache_hit")
+            return self.test_code_cache[norm_name]
             
         # Fuzzy match
         # get_close_matches returns a list, we take the best one if score is good
         matches = difflib.get_close_matches(norm_name, self.test_mappings.keys(), n=1, cutoff=0.7)
+        code = None
         if matches:
             best_match = matches[0]
-            print(f"Fuzzy Match: '{ocr_name}' -> '{best_match}' ({self.test_mappings[best_match]})")
-            return self.test_mappings[best_match]
-            
-        return None
+            code = self.test_mappings[best_match]
+            log.debug("Fuzzy Match: %r -> %r (%s)", ocr_name, best_match, code)
+            METRICS.inc("test_code_lookups", result="fuzzy_hit")
+        else:
+            METRICS.inc("test_code_lookups", result="miss")
+
+        self.test_code_cache[norm_name] = code
+        return code
 
     def get_reliability_level(self, confidence_score):
         if confidence_score >= 85: return "HIGH"
         if confidence_score >= 60: return "MEDIUM"
         return "LOW"
 
-    def is_mostly_symbols(self, text):
-        if not text: return False
+    def symbol_noise_reason(self, text):
+        """
+        Returns the rejection reason if text is mostly symbols/punctuation, else None.
+        """
+        if not text: return None
         clean_text = text.replace(" ", "")
-        if not clean_text: return False
+        if not clean_text: return None
         
         # Valid alphanum (English + Arabic)
         valid_chars = re.findall(r'[a-zA-Z0-9\u0600-\u06FF]', clean_text)
         ratio = len(valid_chars) / len(clean_text)
         
         if ratio < 0.5:
-            print(f"DEBUG: Rejected '{text}' as noise (Symbol Density: {ratio:.2f})")
-            return True
+            log.debug("Rejected %r as noise (Symbol Density: %.2f)", text, ratio)
+            return "symbol_density"
             
         # Punctuation Density Check
         punct_chars = re.findall(r'[^\w\s\u0600-\u06FF]', text)
         punct_ratio = len(punct_chars) / len(text)
         if punct_ratio > 0.4:
-            print(f"DEBUG: Rejected '{text}' as noise (Punct Density: {punct_ratio:.2f})")
-            return True
+            log.debug("Rejected %r as noise (Punct Density: %.2f)", text, punct_ratio)
+            return "punct_density"
             
-        return False
+        return None
 
-    def is_noise(self, test_name):
+    def is_mostly_symbols(self, text):
+        return self.symbol_noise_reason(text) is not None
+
+    def noise_reason(self, test_name):
         """
-        True if test name looks like noise.
+        Returns a short reason string if test name looks like noise, else None.
         """
-        if not test_name: return True
+        if not test_name: return "empty"
         test_name = test_name.strip()
         
         # 0. MUST contain at least some letters (e.g. ":-:33" is noise)
         # Search for at least 2 alphabetic characters (English OR Arabic)
         if len(re.findall(r'[a-zA-Z\u0600-\u06FF]', test_name)) < 2:
-            # print(f"DEBUG: Rejected '{test_name}' (Not enough letters)") 
-            return True
+            # log.debug("Rejected %r (Not enough letters)", test_name)
+            return "few_letters"
             
         # 0.5 Symbol/Punct Density Check
-        if self.is_mostly_symbols(test_name):
-            return True
+        symbol_reason = self.symbol_noise_reason(test_name)
+        if symbol_reason:
+            return symbol_reason
             
         # 0.6 Repeating Characters (e.g. "III", "...")
         if re.search(r'(.)\1{2,}', test_name): # 3 repeated chars
-            print(f"DEBUG: Rejected '{test_name}' (Repeating Chars)")
-            return True
+            log.debug("Rejected %r (Repeating Chars)", test_name)
+            return "repeating_chars"
             
         # 0.7 Garbage Charset (Only numbers + I/l/:/|/!)
         if re.match(r'^[0-9Iil|!:.\-]+$', test_name):
-            print(f"DEBUG: Rejected '{test_name}' (Garbage Charset)")
-            return True
+            log.debug("Rejected %r (Garbage Charset)", test_name)
+            return "garbage_charset"
             
         # 1. Purely numeric or numeric with special chars
-        if re.match(r'^[\d\W]+$', test_name): return True
+        if re.match(r'^[\d\W]+$', test_name): return "numeric"
         
         # 2. IDs like U2199
-        if re.match(r'^[A-Z][\d-]+$', test_name, re.IGNORECASE): return True
+        if re.match(r'^[A-Z][\d-]+$', test_name, re.IGNORECASE): return "id_like"
             
         # 3. Leaked Headers/Metadata (Explicit blacklists)
         noise_keywords = [
@@ -358,13 +853,19 @@ class RobustOCR:
             "REFERENCE", "REVIEWED", "PAGE", "SIGNATURE", "VERIFIED", "NOTES", "COMMENTS"
         ]
         if any(k in test_name.upper() for k in noise_keywords):
-            return True
+            return "header_keyword"
         
         # 4. Check for "Ratio of X of Y" artifacts (e.g. "of :1")
         if re.search(r'\bof\b\s*[:\d]', test_name, re.IGNORECASE):
-             return True
+             return "ratio_artifact"
             
-        return False
+        return None
+
+    def is_noise(self, test_name):
+        """
+        True if test name looks like noise.
+        """
+        return self.noise_reason(test_name) is not None
 
     # Patterns to ignore if found in the "Test Name" column
     METADATA_BLACKLIST = [
@@ -378,14 +879,61 @@ class RobustOCR:
 
 
 
-    def preprocess_image(self, img, page_num):
+    def preprocess_image(self, img, page_num, settings=None):
         """
-        Applies simple preprocessing.
+        Applies the profile's preprocessing (content crop, downscale, gray/binary)
+        and the orientation pre-check.
         Disabled manual deskewing as it can interfere with Doctr's orientation detection.
+        Returns (image, upright, box): upright=True means the pre-check confirmed
+        the page is upright, so docTR's orientation classifier can be skipped;
+        box maps the processed image back to the page (see remap_page_geometry).
         """
-        return img, False
+        settings = settings or PROFILES[self.profile]
+        try:
+            img, box = preprocess_page(img, **settings.get("preprocess", {}))
+        except Exception as e:
+            log.warning("Preprocessing failed on page %d, using raw page: %s", page_num + 1, e)
+            box = (0, 0, img.shape[1], img.shape[0], img.shape[1], img.shape[0])
+
+        upright = False
+        if settings["detect_orientation"]:
+            try:
+                upright = check_upright(img) is True
+            except Exception as e:
+                log.debug("Orientation pre-check failed on page %d: %s", page_num + 1, e)
+        return img, upright, box
 
         
+    HEADER_PATTERNS = {
+        "Test Name": (r"(test|investigation).*(name|parameter)", r"test|name"),
+        "Value": (r"(result|value|observed)", r"result|value|observed"),
+        "Unit": (r"(unit)", r"unit"),
+        "Reference Range": (r"(refer.*range|normal.*values)", r"refer|range|normal")
+    }
+
+    def match_header_line(self, line_words):
+        """
+        Scores one line against HEADER_PATTERNS.
+        Returns (score, column_map, line_text).
+        """
+        line_text = " ".join([w.value.lower() for w in line_words])
+        score = 0
+        cols_found = {}
+        
+        for key, (line_pat, anchor_pat) in self.HEADER_PATTERNS.items():
+            match = re.search(line_pat, line_text)
+            if match:
+                score += 1
+                # Find anchor...
+                for w in line_words:
+                    if re.search(anchor_pat, w.value.lower()):
+                        center_x = (w.geometry[0][0] + w.geometry[1][0]) / 2
+                        cols_found[key] = center_x
+                        break
+        return score, cols_found, line_text
+
+    DEFAULT_ANCHORS = {"Test Name": 0.1, "Value": 0.4, "Unit": 0.6, "Reference Range": 0.8}
+
     def find_header_row(self, pages):
         """
         Scans pages to find the main table header.
@@ -393,58 +941,36 @@ class RobustOCR:
         Fuzzy match: (test|investigation).*(name), (result|value), (unit), (refer.*range)
         Returns: (page_idx, row_geometry, column_map)
         """
-        header_patterns = {
-            "Test Name": (r"(test|investigation).*(name|parameter)", r"test|name"),
-            "Value": (r"(result|value|observed)", r"result|value|observed"),
-            "Unit": (r"(unit)", r"unit"),
-            "Reference Range": (r"(refer.*range|normal.*values)", r"refer|range|normal")
-        }
-        
         for p_idx, page in enumerate(pages):
             # Group words into rough lines first to check for header
             words = [w for b in page.blocks for l in b.lines for w in l.words]
-            words.sort(key=lambda w: (w.geometry[0][1], w.geometry[0][0]))
-            
             if not words: continue
             
-            # Simple line grouping
-            lines = []
-            if words:
-                current_line = [words[0]]
-                for w in words[1:]:
-                    # If vertical distance < 1.5% of page (tuned)
-                    if abs(w.geometry[0][1] - current_line[-1].geometry[0][1]) < 0.015:
-                        current_line.append(w)
-
-                    else:
-                        lines.append(current_line)
-                        current_line = [w]
-                lines.append(current_line)
-            
-            for line_words in lines:
-                line_text = " ".join([w.value.lower() for w in line_words])
-                score = 0
-                cols_found = {}
-                
-                for key, (line_pat, anchor_pat) in header_patterns.items():
-                    match = re.search(line_pat, line_text)
-                    if match:
-                        score += 1
-                        # Find anchor...
-                        for w in line_words:
-                            if re.search(anchor_pat, w.value.lower()):
-                                center_x = (w.geometry[0][0] + w.geometry[1][0]) / 2
-                                cols_found[key] = center_x
-                                break
+            for line_words in group_lines(words):
+                score, cols_found, line_text = self.match_header_line(line_words)
 
                 if score >= 2: # At least 2 matches
-                    print(f"Header found on Page {p_idx+1}: {line_text}")
+                    log.info("Header found on Page %d: %s", p_idx + 1, line_text)
                     # Calculate bounding box of the header line
                     max_y = max([w.geometry[1][1] for w in line_words])
                     return p_idx, max_y, cols_found
                     
-        print("Warning: No clear header found. Using default structure.")
-        return 0, 0.15, {"Test Name": 0.1, "Value": 0.4, "Unit": 0.6, "Reference Range": 0.8}
+        log.warning("No clear header found. Using default structure.")
+        return 0, 0.15, dict(self.DEFAULT_ANCHORS)
+
+    def analyze_layout(self, pages):
+        """
+        Full layout analysis: header row, column ranges and row threshold.
+        """
+        start_page, header_bottom, anchors = self.find_header_row(pages)
+        return {
+            "start_page": start_page,
+            "header_bottom": header_bottom,
+            "anchors": anchors,
+            "col_ranges": self.get_column_ranges(anchors),
+            "row_threshold": self.calculate_adaptive_threshold(pages),
+            "header_found": anchors != self.DEFAULT_ANCHORS
+        }
 
     def calculate_adaptive_threshold(self, pages):
         """
@@ -461,7 +987,7 @@ class RobustOCR:
         if not heights: return 0.015
         median = np.median(heights)
         adaptive = median * 0.7 
-        print(f"Adaptive Row Threshold: {adaptive:.4f} (Median Height: {median:.4f})")
+        log.debug("Adaptive Row Threshold: %.4f (Median Height: %.4f)", adaptive, median)
         return max(0.005, min(0.02, adaptive)) # Safety clamp
 
     def get_column_ranges(self, anchors):
@@ -493,161 +1019,658 @@ class RobustOCR:
             
         return ranges
 
-    def extract_patient_name(self, image_path, header_bottom, doc=None):
-        """
-        Uses EasyOCR (Arabic+English) to extract name.
-        Fallback to doc (Doctr) if available.
-        """
-        # --- Shared Regex Patterns ---
-        patt_chars = r"[A-Za-z\s\.\u0600-\u06FF]+"
-        searches = [
-            # 1. Full Anchor with lookahead keywords
-            r"(?:Patient\s*Name|Name)\s*[:\-\.]?\s*(?:\d+[\d:]*\s+)?(" + patt_chars + r"?)\s+(?:ID|Ref|Date|Sex|Age|File|Lab|Coll|Auth|Print|Test|Res|Unit|Visit)",
-            # 2. Arabic "Name" (Ism | Al-Ism)
-            r"(?:الاسم|اسم المريض)\s*[:\-\.]?\s*(" + patt_chars + r"?)\s+(?:ID|Ref|Date|Sex|Age|File|Lab|Coll|Visit)",
-            # 3. Just "Patient Name: Name" (No lookahead enforcement if EOL)
-            r"(?:Patient\s*Name|Name)\s*[:\-\.]?\s*(" + patt_chars + r")",
-            # Honorifics
-            r"(?:Mr\.|Mrs\.|Ms\.|Miss|السيد|السيدة)\s*(" + patt_chars + r")"
-        ]
+    # --- Patient Name Regex Patterns ---
+    NAME_PATT_CHARS = r"[A-Za-z\s\.\u0600-\u06FF]+"
+    NAME_SEARCHES = [
+        # 1. Full Anchor with lookahead keywords
+        r"(?:Patient\s*Name|Name)\s*[:\-\.]?\s*(?:\d+[\d:]*\s+)?(" + NAME_PATT_CHARS + r"?)\s+(?:ID|Ref|Date|Sex|Age|File|Lab|Coll|Auth|Print|Test|Res|Unit|Visit)",
+        # 2. Arabic "Name" (Ism | Al-Ism)
+        r"(?:الاسم|اسم المريض)\s*[:\-\.]?\s*(" + NAME_PATT_CHARS + r"?)\s+(?:ID|Ref|Date|Sex|Age|File|Lab|Coll|Visit)",
+        # 3. Just "Patient Name: Name" (No lookahead enforcement if EOL)
+        r"(?:Patient\s*Name|Name)\s*[:\-\.]?\s*(" + NAME_PATT_CHARS + r")",
+        # Honorifics
+        r"(?:Mr\.|Mrs\.|Ms\.|Miss|السيد|السيدة)\s*(" + NAME_PATT_CHARS + r")"
+    ]
+    NAME_REGEXES = [re.compile(p, re.IGNORECASE) for p in NAME_SEARCHES]
 
-        # --- 1. Try EasyOCR ---
-        print(f"DEBUG: Running EasyOCR on {image_path} for name extraction...")
-        try:
-            reader = easyocr.Reader(['ar', 'en'], gpu=False) # GPU=False for safety on user machine
-            
-            img = cv2.imread(image_path)
-            h, w, _ = img.shape
+    # Engine order for each profile name_strategy
+    NAME_STRATEGIES = {
+        "easyocr_first": ("EasyOCR", "Doctr"),
+        "doctr_first": ("Doctr", "EasyOCR"),
+        "doctr_only": ("Doctr",)
+    }
+
+    def match_patient_name(self, text, engine):
+        """
+        Runs the name patterns over text. Returns the cleaned name or None.
+        """
+        for i, regex in enumerate(self.NAME_REGEXES):
+            match = regex.search(text)
+            if match:
+                extracted = match.group(1).strip()
+                extracted_clean = re.sub(r'[^\w\s\u0600-\u06FF\.]', '', extracted).strip()
+                if len(extracted_clean) > 2:
+                    log.info("Found Patient Name (%s - Pat %d): %s", engine, i, extracted_clean)
+                    return extracted_clean
+        return None
+
+    NAME_ANCHOR_RE = re.compile(r"(?:Patient\s*Name|Name|الاسم|اسم المريض|Mr\.|Mrs\.|Ms\.|Miss|السيد|السيدة)\s*[:\-\.]?", re.IGNORECASE)
+    ARABIC_RE = re.compile(r"[\u0600-\u06FF]")
+    NAME_STOP_RE = re.compile(r"(?:ID|Ref|Date|Sex|Age|File|Lab|Coll|Auth|Print|Test|Res|Unit|Visit)\b", re.IGNORECASE)
+    NAME_MIN_CONFIDENCE = 0.5 # Below this docTR (Latin vocab) is likely misreading Arabic script
+
+    def find_name_line(self, doc):
+        """
+        The page-1 docTR line holding the name anchor ("Patient Name", "Mr." ...),
+        as a list of words left to right, or None.
+        """
+        words = [w for b in doc.pages[0].blocks for l in b.lines for w in l.words
+                 if w.geometry[1][1] < self.NAME_REGION_BOTTOM]
+        for line in group_lines(words):
+            line = sorted(line, key=lambda w: w.geometry[0][0])
+            if self.NAME_ANCHOR_RE.search(" ".join(w.value for w in line)):
+                return line
+        return None
+
+    def name_needs_easyocr(self, line):
+        """
+        True when the name line looks like Arabic script to docTR: Arabic
+        characters, or low-confidence / missing words after the anchor.
+        """
+        text = " ".join(w.value for w in line)
+        if self.ARABIC_RE.search(text):
+            return True
+        anchor_end = next((i for i, w in enumerate(line) if self.NAME_ANCHOR_RE.search(w.value)), 0)
+        after = []
+        for w in line[anchor_end + 1:]:
+            if self.NAME_STOP_RE.match(w.value):
+                break
+            after.append(w)
+        return not after or np.mean([w.confidence for w in after]) < self.NAME_MIN_CONFIDENCE
+
+    def easyocr_name_text(self, image_path, geometry=None):
+        """
+        EasyOCR (Arabic+English) text of the name line's box (relative geometry
+        of the processed page image), or of the top third of the page.
+        """
+        import cv2
+        log.debug("Running EasyOCR on %s for name extraction...", image_path)
+        reader = self.get_name_reader()
+        
+        img = cv2.imread(image_path)
+        h, w, _ = img.shape
+        if geometry is not None:
+            crop_img = crop_word(img, geometry)
+            if crop_img is None:
+                return ""
+        else:
             crop_h = int(h * 0.33)
             crop_img = img[0:crop_h, 0:w]
-            
-            results = reader.readtext(crop_img, detail=0, paragraph=True)
-            full_text = " ".join(results)
-            # print("DEBUG: EasyOCR Raw Header Text:\n" + full_text)
-            print(f"DEBUG: Full Text Repr: {repr(full_text)}")
-            
-            with open(DEBUG_FILE, "a", encoding="utf-8") as f:
-                f.write(f"\n--- EasyOCR Extraction for {os.path.basename(image_path)} ---\n")
-                f.write(full_text + "\n------------------------------------------------\n")
-            
-            for i, pattern in enumerate(searches):
-                match = re.search(pattern, full_text, re.IGNORECASE)
-                if match:
-                    extracted = match.group(1).strip()
-                    extracted_clean = re.sub(r'[^\w\s\u0600-\u06FF\.]', '', extracted).strip()
-                    if len(extracted_clean) > 2:
-                        print(f"Found Patient Name (EasyOCR - Pat {i}): {extracted_clean}")
-                        return extracted_clean
-            
-        except Exception as e:
-            print(f"Error in EasyOCR name extraction: {e}")
+        
+        results = reader.readtext(crop_img, detail=0, paragraph=True)
+        full_text = " ".join(results)
+        log.debug("Full Text Repr: %r", full_text)
+        return full_text
+
+    def doctr_name_text(self, doc):
+        """
+        docTR text of the upper part of page 1.
+        """
+        # Aggregate text from Page 0 top 30%
+        doctr_text = []
+        for page in doc.pages[:1]: # Check first page only
+            for b in page.blocks:
+                if b.geometry[1][1] < 0.35: # Upper part
+                     for l in b.lines:
+                         doctr_text.append(" ".join([w.value for w in l.words]))
+        
+        full_doctr_text = " ".join(doctr_text)
+        log.debug("Doctr Text: %.100s...", full_doctr_text)
+        return full_doctr_text
+
+    def name_line_box(self, line, box=None):
+        """
+        Padded box of the name line in the processed page image's relative
+        coordinates. Extends to the right margin when no name word was detected
+        after the anchor. box is the page's preprocess crop box.
+        """
+        (x0, y0), (x1, y1) = line_bbox(line)
+        pad_y = (y1 - y0) * 0.5
+        if len(line) == 1:
+            x1 = 1.0
+        (x0, y0), (x1, y1) = (x0 - 0.01, y0 - pad_y), (x1 + 0.01, y1 + pad_y)
+        if box is not None:
+            # Page geometry was remapped to the full page; the image on disk is the crop
+            bx, by, cw, ch, w, h = box
+            x0, x1 = [(x * w - bx) / cw for x in (x0, x1)]
+            y0, y1 = [(y * h - by) / ch for y in (y0, y1)]
+        return (x0, y0), (x1, y1)
 
-        # --- 2. Fallback to Doctr ---
-        if doc:
-            print("DEBUG: EasyOCR failed key match. Trying Doctr fallback...")
+    def extract_patient_name(self, image_path, header_bottom, doc=None, trace=NULL_TRACE, strategy="doctr_first", box=None):
+        """
+        Extracts the patient name with the docTR output and/or EasyOCR,
+        in the order given by strategy (see NAME_STRATEGIES).
+        With "doctr_first", EasyOCR only reads the name line's bounding box, and
+        only when docTR found no name or the line looks like Arabic script.
+        Raw header text is saved to the document trace when tracing is enabled.
+        """
+        if strategy == "doctr_first" and doc:
+            return self.doctr_first_name(image_path, doc, trace, box)
+
+        for engine in self.NAME_STRATEGIES[strategy]:
+            if engine == "Doctr" and not doc:
+                continue
             try:
-                # Aggregate text from Page 0 top 30%
-                doctr_text = []
-                for page in doc.pages[:1]: # Check first page only
-                    for b in page.blocks:
-                        if b.geometry[1][1] < 0.35: # Upper part
-                             for l in b.lines:
-                                 doctr_text.append(" ".join([w.value for w in l.words]))
+                if engine == "EasyOCR":
+                    text = self.easyocr_name_text(image_path)
+                    trace.text("name_easyocr", text)
+                else:
+                    text = self.doctr_name_text(doc)
+                    trace.text("name_doctr", text)
                 
-                full_doctr_text = " ".join(doctr_text)
-                print(f"DEBUG: Doctr Fallback Text: {full_doctr_text[:100]}...") 
-
-                with open(DEBUG_FILE, "a", encoding="utf-8") as f:
-                     f.write(f"\n--- Doctr Fallback Extraction for {os.path.basename(image_path)} ---\n")
-                     f.write(full_doctr_text + "\n------------------------------------------------\n")
-
-                for i, pattern in enumerate(searches):
-                    match = re.search(pattern, full_doctr_text, re.IGNORECASE)
-                    if match:
-                        extracted = match.group(1).strip()
-                        extracted_clean = re.sub(r'[^\w\s\u0600-\u06FF\.]', '', extracted).strip()
-                        if len(extracted_clean) > 2:
-                            print(f"Found Patient Name (Doctr - Pat {i}): {extracted_clean}")
-                            return extracted_clean
-
+                name = self.match_patient_name(text, engine)
+                if name:
+                    return name
             except Exception as e:
-                print(f"Error in Doctr fallback: {e}")
+                log.error("Error in %s name extraction: %s", engine, e)
 
-        print("DEBUG: No regex match for patient name (EasyOCR + Doctr).")    
+        log.debug("No regex match for patient name (%s).", " + ".join(self.NAME_STRATEGIES[strategy]))
         return None
 
 
-    def process_document(self, file_path_or_images, patient_manager=None):
+    def doctr_first_name(self, image_path, doc, trace=NULL_TRACE, box=None):
+        text = self.doctr_name_text(doc)
+        trace.text("name_doctr", text)
+        name = self.match_patient_name(text, "Doctr")
+        line = self.find_name_line(doc)
+        if name and not (line and self.name_needs_easyocr(line)):
+            METRICS.inc("name_extraction", engine="doctr")
+            return name
+
+        try:
+            geometry = self.name_line_box(line, box) if line else None
+            if geometry is None:
+                # docTR found no anchor line: all page-1 words of the name region
+                words = [w for b in doc.pages[0].blocks for l in b.lines for w in l.words
+                         if w.geometry[1][1] < self.NAME_REGION_BOTTOM]
+                geometry = self.name_line_box(words, box) if words else None
+            easy_text = self.easyocr_name_text(image_path, geometry)
+            trace.text("name_easyocr", easy_text)
+            easy_name = self.match_patient_name(easy_text, "EasyOCR")
+            if not easy_name and line:
+                # The crop is the name line itself: whatever follows the anchor
+                rest = self.NAME_ANCHOR_RE.split(easy_text, maxsplit=1)[-1]
+                rest = re.sub(r'[^\w\s\u0600-\u06FF\.]', '', rest).strip()
+                easy_name = rest if len(rest) > 2 else None
+            if easy_name:
+                METRICS.inc("name_extraction", engine="easyocr_line" if line else "easyocr_region")
+                return easy_name
+        except Exception as e:
+            log.error("Error in EasyOCR name extraction: %s", e)
+
+        if name:
+            METRICS.inc("name_extraction", engine="doctr")
+        else:
+            METRICS.inc("name_extraction", engine="none")
+            log.debug("No regex match for patient name (docTR + EasyOCR name line).")
+        return name
+
+    def run_predictor(self, image_paths, profile_name, settings, upright_pages):
+        """
+        Runs docTR over the pages. When the profile detects orientation, pages the
+        pre-check confirmed upright go through the orientation-free predictor and
+        only the undecided ones pay for orientation estimation.
+        """
+        if not settings["detect_orientation"]:
+            return self.get_predictor(profile_name)(load_document_images(image_paths, self.backend))
+
+        upright_idx = [i for i, up in enumerate(upright_pages) if up]
+        other_idx = [i for i, up in enumerate(upright_pages) if not up]
+        METRICS.inc("orientation_checks", len(upright_idx), result="skipped_upright")
+        METRICS.inc("orientation_checks", len(other_idx), result="undecided")
+        log.info("Orientation pre-check: %d/%d pages upright, classifier skipped", len(upright_idx), len(image_paths))
+
+        if not upright_idx or not other_idx:
+            model = self.get_predictor(profile_name, detect_orientation=not upright_idx)
+            return model(load_document_images(image_paths, self.backend))
+
+        upright_doc = self.get_predictor(profile_name, detect_orientation=False)(
+            load_document_images([image_paths[i] for i in upright_idx], self.backend))
+        other_doc = self.get_predictor(profile_name)(
+            load_document_images([image_paths[i] for i in other_idx], self.backend))
+
+        # Stitch pages back into document order; downstream code only reads doc.pages
+        pages = [None] * len(image_paths)
+        for i, page in zip(upright_idx, upright_doc.pages): pages[i] = page
+        for i, page in zip(other_idx, other_doc.pages): pages[i] = page
+        upright_doc.pages = pages
+        return upright_doc
+
+    # Interpretation/appendix text (e.g. CDC recommendations). Such lines are not
+    # results, but parsing carries on after them: a page is only skipped when
+    # the table has ended and the page has no row-shaped line left.
+    APPENDIX_RE = re.compile(r"^\W*(?:(?:interpretations?|recommendations?|cdc|guidelines?|clinical significance|disclaimer|methodology)\b\W*)+", re.IGNORECASE)
+    APPENDIX_CUE_RE = re.compile(r"\b(?:interpretations?|recommend\w*|cdc|guidelines?|clinical significance|disclaimer|methodology|according to)\b", re.IGNORECASE)
+    APPENDIX_MIN_WORDS = 8 # Prose line, not a table row
+    VALUE_LIKE_RE = re.compile(r"\d+|negative|positive|reactive", re.IGNORECASE)
+    ROW_MIN_GAP = 0.05 # Relative page width; prose lines have no gap this wide between words
+    TABLE_PAGE_BATCH = 4 # Pages per predictor call once the header is found
+
+    def is_appendix_line(self, line_words, value_text=""):
+        """
+        True for an appendix heading ("Interpretation:", "CDC Recommendations")
+        or a prose line mentioning one ("According to CDC recommendation ...").
+        A line with a result in its Value column (value_text) is a table row,
+        even with a reference note ("LDL 120 mg/dL < 100 recommended by NCEP")
+        or a heading-like name ("Interpretation: Non-reactive").
+        """
+        if self.VALUE_LIKE_RE.search(value_text):
+            return False
+        text = " ".join(w.value for w in line_words)
+        if len(line_words) >= self.APPENDIX_MIN_WORDS and self.APPENDIX_CUE_RE.search(text):
+            return True
+        m = self.APPENDIX_RE.match(text)
+        return bool(m) and (":" in m.group() or not text[m.end():].strip())
+
+    def column_words(self, line_words, col_ranges, col_name):
+        c_start, c_end = col_ranges[col_name]
+        return [w for w in line_words if c_start <= (w.geometry[0][0] + w.geometry[1][0]) / 2 <= c_end]
+
+    def is_data_line(self, line_words, col_ranges):
+        """
+        Recognized line shaped like a result row: a test name and a result-like
+        value in their columns, and not appendix prose.
+        """
+        if "Test Name" not in col_ranges or "Value" not in col_ranges:
+            return True # Can't tell without the columns: never treat as the end
+        value_text = " ".join(w.value for w in self.column_words(line_words, col_ranges, "Value"))
+        return (bool(self.column_words(line_words, col_ranges, "Test Name")) and bool(self.VALUE_LIKE_RE.search(value_text))
+                and not self.is_appendix_line(line_words, value_text))
+
+    def may_hold_rows(self, lines, col_ranges):
+        """
+        Detection-only check (no text yet): whether any line could be a result
+        row, i.e. has words in both the Test Name and Value columns with a
+        column gap between words (running prose has none).
+        """
+        if "Test Name" not in col_ranges or "Value" not in col_ranges:
+            return True
+        for line in lines:
+            xs = sorted((w.geometry[0][0], w.geometry[1][0]) for w in line)
+            gap = max((b[0] - a[1] for a, b in zip(xs, xs[1:])), default=0.0)
+            if gap >= self.ROW_MIN_GAP and self.column_words(line, col_ranges, "Test Name") and self.column_words(line, col_ranges, "Value"):
+                return True
+        return False
+
+    def table_ended(self, lines, col_ranges, ended=False):
+        """
+        Whether the table has ended after reading lines (recognized, in page
+        order), given whether it had ended before them: an appendix line ends
+        it, a later result row resumes it.
+        """
+        for line in lines:
+            if self.is_data_line(line, col_ranges):
+                ended = False
+            elif self.is_appendix_line(line):
+                ended = True
+        return ended
+
+    def lines_below(self, page, header_bottom):
+        # Same band extract_rows reads: everything below the header line
+        return [l for l in group_lines([w for b in page.blocks for l in b.lines for w in l.words])
+                if l[0].geometry[0][1] > header_bottom]
+
+    def detect_page_lines(self, predictor, pages, page_boxes):
+        """
+        Detection only: per page, word boxes (no text) grouped into lines.
+        Boxes are mapped to full-page coordinates with page_boxes (see
+        preprocess_page), the frame the header and column positions use.
+        """
+        with METRICS.stage("detect"):
+            det_out = predictor.det_predictor(pages)
+        page_lines = []
+        for out, box in zip(det_out, page_boxes):
+            words = []
+            for b in detection_boxes(out):
+                geom = ((float(b[0]), float(b[1])), (float(b[2]), float(b[3])))
+                words.append(OCRWord(None, 0.0, geom if is_full_page(box) else to_page_geometry(geom, box)))
+            page_lines.append(group_lines(words))
+        return page_lines
+
+    def run_progressive(self, image_paths, profile_name, settings, upright_pages, page_boxes):
+        """
+        Full-predictor OCR that stops reading at the end of the results table.
+        Pages are OCR'd one at a time until the table header is found (page 1
+        is always read for the patient name), then in batches of
+        TABLE_PAGE_BATCH. Once a page ends in appendix text, the remaining
+        upright pages go through detection only, and pages without a
+        row-shaped line are not recognized; they come back empty so page
+        indices stay aligned.
+        Pages are mapped to full-page coordinates (page_boxes) as soon as they
+        are read, so positions compare across differently cropped pages.
+        """
+        n = len(image_paths)
+        pages = [None] * n
+        header_bottom, col_ranges = None, None
+        p_idx = 0
+        while p_idx < n and header_bottom is None:
+            page = self.run_predictor([image_paths[p_idx]], profile_name, settings, upright_pages[p_idx:p_idx + 1]).pages[0]
+            remap_page_geometry(page, page_boxes[p_idx])
+            pages[p_idx] = page
+            lines = group_lines([w for b in page.blocks for l in b.lines for w in l.words])
+            for line in lines:
+                score, anchors, _ = self.match_header_line(line)
+                if score >= 2:
+                    header_bottom = max(w.geometry[1][1] for w in line)
+                    col_ranges = self.get_column_ranges(anchors)
+                    break
+            p_idx += 1
+
+        if header_bottom is not None:
+            remaining = list(range(p_idx, n))
+            ended = self.table_ended(self.lines_below(pages[p_idx - 1], header_bottom), col_ranges)
+            screened = False
+            while remaining:
+                if ended and not screened:
+                    screened = True
+                    upright = [i for i in remaining if upright_pages[i]]
+                    if upright:
+                        predictor = self.get_predictor(profile_name, detect_orientation=False)
+                        page_lines = self.detect_page_lines(predictor, load_document_images([image_paths[i] for i in upright], self.backend),
+                                                            [page_boxes[i] for i in upright])
+                        prose = {i for i, pl in zip(upright, page_lines)
+                                 if not self.may_hold_rows([l for l in pl if l[0].geometry[0][1] > header_bottom], col_ranges)}
+                        remaining = [i for i in remaining if i not in prose]
+                        if not remaining:
+                            break
+                batch, remaining = remaining[:self.TABLE_PAGE_BATCH], remaining[self.TABLE_PAGE_BATCH:]
+                doc = self.run_predictor([image_paths[i] for i in batch], profile_name, settings, [upright_pages[i] for i in batch])
+                for i, page in zip(batch, doc.pages):
+                    remap_page_geometry(page, page_boxes[i])
+                    pages[i] = page
+                    ended = self.table_ended(self.lines_below(page, header_bottom), col_ranges, ended)
+
+        skipped = [i for i, page in enumerate(pages) if page is None]
+        if skipped:
+            METRICS.inc("pages_skipped", len(skipped), reason="appendix")
+            log.info("Table ended: skipped OCR of appendix page(s) %s", ", ".join(str(i + 1) for i in skipped))
+            pages = [page if page is not None else OCRPage([], (box[5], box[4])) for page, box in zip(pages, page_boxes)]
+        return OCRDocument(pages)
+
+    TWO_PHASE_CHUNK = 12 # Lines recognized per batch while scanning for the header/footer
+    NAME_REGION_BOTTOM = 0.35 # Page-1 area the docTR name extraction reads
+
+    def run_two_phase(self, image_paths, profile_name, page_boxes):
+        """
+        Detection on every page, recognition only where the pipeline reads text:
+        lines from the top of the document down to the table header, the page-1
+        name region, and table rows below the header up to the footer.
+        Each page is cropped differently, so geometry is mapped to full-page
+        coordinates (page_boxes) before comparing positions across pages.
+        Returns an OCRDocument with the same page/block/line/word shape as docTR's,
+        already in full-page coordinates.
+        """
+        predictor = self.get_predictor(profile_name)
+        pages = load_document_images(image_paths, self.backend)
+
+        # Phase 1: detection only
+        page_lines = self.detect_page_lines(predictor, pages, page_boxes)
+        done = [set() for _ in pages]
+        stats = {"detected": sum(len(l) for lines in page_lines for l in lines), "recognized": 0}
+
+        def recognize(p_idx, line_ids):
+            line_ids = [i for i in line_ids if i not in done[p_idx]]
+            words = [w for i in line_ids for w in page_lines[p_idx][i]]
+            done[p_idx].update(line_ids)
+            crops = [crop_word(pages[p_idx], to_crop_geometry(w.geometry, page_boxes[p_idx])) for w in words]
+            keep = [j for j, c in enumerate(crops) if c is not None]
+            if keep:
+                with METRICS.stage("recognize"):
+                    preds = predictor.reco_predictor([crops[j] for j in keep])
+                for j, (value, conf) in zip(keep, preds):
+                    words[j].value = value
+                    words[j].confidence = float(conf)
+                stats["recognized"] += len(keep)
+            return [[w for w in page_lines[p_idx][i] if w.value] for i in line_ids]
+
+        # Phase 2a: header search, top-down in chunks
+        header_page, header_bottom, col_ranges = None, 0.0, {}
+        for p_idx, lines in enumerate(page_lines):
+            for start in range(0, len(lines), self.TWO_PHASE_CHUNK):
+                for line in recognize(p_idx, range(start, min(start + self.TWO_PHASE_CHUNK, len(lines)))):
+                    score, anchors, _ = self.match_header_line(line) if line else (0, None, None)
+                    if score >= 2:
+                        header_page, header_bottom = p_idx, max(w.geometry[1][1] for w in line)
+                        col_ranges = self.get_column_ranges(anchors)
+                        break
+                if header_page is not None: break
+            if header_page is not None: break
+
+        if header_page is not None:
+            # Phase 2b: patient-name region on page 1
+            if page_lines:
+                recognize(0, [i for i, l in enumerate(page_lines[0]) if l[0].geometry[0][1] < self.NAME_REGION_BOTTOM])
+
+            # Phase 2c: table rows below the header, stopping each page at the footer.
+            # Once the table has ended in appendix text, lines (and whole pages)
+            # with no row-shaped line left are not recognized.
+            ended = False
+            skipped = []
+            for p_idx in range(header_page, len(pages)):
+                below = [i for i, l in enumerate(page_lines[p_idx]) if l[0].geometry[0][1] > header_bottom]
+                if ended and not self.may_hold_rows([page_lines[p_idx][i] for i in below], col_ranges):
+                    skipped.append(p_idx)
+                    continue
+                read = []
+                for start in range(0, len(below), self.TWO_PHASE_CHUNK):
+                    line_ids = below[start:start + self.TWO_PHASE_CHUNK]
+                    recognize(p_idx, line_ids)
+                    # Lines read during the header search count too
+                    chunk = [[w for w in page_lines[p_idx][i] if w.value] for i in line_ids]
+                    read += [l for l in chunk if l]
+                    text = " ".join(w.value.lower() for l in chunk for w in l)
+                    if "signature" in text or "professor" in text:
+                        break
+                    rest = [page_lines[p_idx][i] for i in below[start + self.TWO_PHASE_CHUNK:]]
+                    if rest and self.table_ended(read, col_ranges, ended) and not self.may_hold_rows(rest, col_ranges):
+                        break
+                ended = self.table_ended(read, col_ranges, ended)
+            if skipped:
+                METRICS.inc("pages_skipped", len(skipped), reason="appendix")
+                log.info("Table ended: skipped appendix page(s) %s", ", ".join(str(i + 1) for i in skipped))
+        # No header: everything was recognized during the search, same as the full predictor
+
+        METRICS.inc("words_detected", stats["detected"])
+        METRICS.inc("words_recognized", stats["recognized"])
+        log.info("Two-phase OCR: recognized %d of %d detected words", stats["recognized"], stats["detected"])
+
+        doc_pages = []
+        for p_idx, lines in enumerate(page_lines):
+            blocks = []
+            for i in sorted(done[p_idx]):
+                words = [w for w in lines[i] if w.value]
+                if words:
+                    geom = line_bbox(words)
+                    blocks.append(OCRBlock(geom, [OCRLine(geom, words)]))
+            doc_pages.append(OCRPage(blocks, (page_boxes[p_idx][5], page_boxes[p_idx][4])))
+        return OCRDocument(doc_pages)
+
+    def load_pages(self, paths, settings):
+        """
+        Yields BGR page images for a list of PDF and image paths, in order.
+        Images are decoded in memory, EXIF-rotated and capped to the
+        resolution a scan at the profile's DPI would have.
+        """
+        import cv2
+        for path in paths:
+            if path.lower().endswith('.pdf'):
+                from pdf2image import convert_from_path
+                with METRICS.stage("rasterize"):
+                    images = convert_from_path(path, dpi=settings["dpi"], poppler_path=r"D:\Release-25.07.0-0\poppler-25.07.0\Library\bin")
+                for img in images:
+                    yield np.array(img)[:, :, ::-1] # RGB to BGR
+            elif is_image_file(path):
+                with open(path, "rb") as f:
+                    data = f.read()
+                with METRICS.stage("decode_image"):
+                    try:
+                        pages = decode_image(data, max_side=round(PAGE_LONG_SIDE_INCHES * settings["dpi"]))
+                    except Exception as e:
+                        log.error("Could not decode image %s: %s", path, e)
+                        pages = [None]
+                yield from pages
+            else:
+                yield cv2.imread(path)
+
+    def process_document(self, file_path_or_images, patient_manager=None, profile=None):
+        """
+        OCRs a PDF or image path, or a list of page files (images or PDFs, in page order)
+        as one report and extracts result rows.
+        profile selects a PROFILES entry (default: this instance's profile).
+        Returns (results, (patient_id, normalized_name)).
+        """
+        ctx = DocumentContext(file_path_or_images, *get_profile(profile or self.profile))
+        try:
+            return self._process_document(ctx, patient_manager)
+        finally:
+            ctx.close()
+
+    def _process_document(self, ctx, patient_manager):
+        file_path_or_images, trace = ctx.source, ctx.trace
+        profile_name, settings = ctx.profile_name, ctx.settings
         if isinstance(file_path_or_images, str) and file_path_or_images.lower().endswith('.pdf'):
-            print(f"Processing PDF: {file_path_or_images}")
-            images = convert_from_path(file_path_or_images, poppler_path=r"D:\Release-25.07.0-0\poppler-25.07.0\Library\bin")
+            log.info("Processing PDF: %s", file_path_or_images)
+            page_images = self.load_pages([file_path_or_images], settings)
+        elif isinstance(file_path_or_images, str) and is_image_file(file_path_or_images):
+            log.info("Processing image: %s", file_path_or_images)
+            page_images = self.load_pages([file_path_or_images], settings)
+        elif isinstance(file_path_or_images, list):
+             # Pages of one report: image files and/or PDFs, in order (e.g. a batch upload)
+             page_images = self.load_pages(file_path_or_images, settings)
+        else:
+             log.error("Invalid input: %r", file_path_or_images)
+             return [], None
+
+        import cv2
+        with METRICS.stage("preprocess"):
             # Save tmp images for doctr
             image_paths = []
-            for i, img in enumerate(images):
-                path = os.path.join(LOGS_DIR, f"temp_page_{i}.png")
-                
-                # Check for skew correction 
-                open_cv_image = np.array(img) 
-                open_cv_image = open_cv_image[:, :, ::-1].copy() # RGB to BGR
-                
-                processed_img, was_corrected = self.preprocess_image(open_cv_image, i)
+            upright_pages = []
+            page_boxes = []
+            for i, img in enumerate(page_images):
+                if img is None:
+                    log.error("Could not read page %d of %r", i + 1, file_path_or_images)
+                    return [], None
+                path = ctx.page_path(i)
+                processed_img, upright, box = self.preprocess_image(img, i, settings)
                 cv2.imwrite(path, processed_img)
                 image_paths.append(path)
-        elif isinstance(file_path_or_images, list):
-             image_paths = file_path_or_images
-        else:
-             print("Invalid input")
-             return [], None
+                upright_pages.append(upright)
+                page_boxes.append(box)
+
+        METRICS.inc("documents", profile=profile_name)
+        METRICS.inc("pages", len(image_paths))
 
-        model = ocr_predictor(pretrained=True, detect_orientation=True)
-        doc = model(DocumentFile.from_images(image_paths))
+        if settings.get("two_phase") and not settings["detect_orientation"]:
+            doc = self.run_two_phase(image_paths, profile_name, page_boxes)
+        else:
+            # docTR's predictor runs detection and recognition in one call; pages are
+            # batched after the header, and appendix-only pages are not recognized
+            with METRICS.stage("detect_recognize"):
+                doc = self.run_progressive(image_paths, profile_name, settings, upright_pages, page_boxes)
         
-        # Header/Config Analysis
-        start_page, header_bottom, anchors = self.find_header_row(doc.pages)
-        col_ranges = self.get_column_ranges(anchors)
-        row_threshold = self.calculate_adaptive_threshold(doc.pages)
+        # Header/Config Analysis (cached per lab layout when a template matches)
+        with METRICS.stage("layout"):
+            template = self.templates.match(doc.pages, self.match_header_line) if self.templates is not None else None
+            if template is not None:
+                METRICS.inc("layout_templates", result="hit")
+                log.info("Using layout template %s", template["id"])
+                layout = LayoutTemplateStore.layout_of(template)
+            else:
+                if self.templates is not None:
+                    METRICS.inc("layout_templates", result="miss")
+                layout = self.analyze_layout(doc.pages)
+        start_page, header_bottom = layout["start_page"], layout["header_bottom"]
+        trace.anchors(start_page, header_bottom, layout["anchors"])
         
         # Extract Patient Name from Page 0 (Using EasyOCR on the image)
         first_page_img = image_paths[0]
-        raw_patient_name = self.extract_patient_name(first_page_img, header_bottom if start_page == 0 else 0.3, doc)
+        with METRICS.stage("name_extraction"):
+            raw_patient_name = self.extract_patient_name(first_page_img, header_bottom if start_page == 0 else 0.3, doc, trace,
+                                                         strategy=settings["name_strategy"], box=page_boxes[0])
 
         
         if not raw_patient_name:
-            print("Warning: Could not extract patient name automatically.")
+            log.warning("Could not extract patient name automatically.")
             raw_patient_name = "Unknown Patient"
             
         # Get ID
         patient_id, normalized_name = "UNKNOWN", "UNKNOWN"
         if patient_manager:
-            patient_id, normalized_name = patient_manager.get_or_create_id(raw_patient_name)
-            print(f"Assigned ID {patient_id} to '{raw_patient_name}'")
+            with METRICS.stage("registry"):
+                patient_id, normalized_name = patient_manager.get_or_create_id(raw_patient_name)
+            log.info("Assigned ID %s to %r", patient_id, raw_patient_name)
+
+        results, quality = self.extract_rows(doc, layout, patient_id, normalized_name, trace)
+
+        if self.templates is not None:
+            if template is not None:
+                if not self.templates.record(template, quality):
+                    # Cached layout no longer fits this lab's reports: redo full analysis
+                    log.info("Re-running layout analysis after template invalidation")
+                    with METRICS.stage("layout"):
+                        layout = self.analyze_layout(doc.pages)
+                    trace.anchors(layout["start_page"], layout["header_bottom"], layout["anchors"])
+                    results, quality = self.extract_rows(doc, layout, patient_id, normalized_name, trace)
+                    if layout["header_found"]:
+                        self.templates.learn(doc.pages, layout, quality)
+            elif layout["header_found"]:
+                self.templates.learn(doc.pages, dict(layout, footer_cues=quality["footer_cues"]), quality)
+
+        with METRICS.stage("flags"):
+            add_flags(results)
+        return results, (patient_id, normalized_name)
+
+    FOOTER_KEYWORDS = ("signature", "professor")
+
+    def extract_rows(self, doc, layout, patient_id, normalized_name, trace=NULL_TRACE):
+        """
+        Builds result rows from the words below the header using the column ranges.
+        A page stops at its footer; appendix/interpretation lines are skipped
+        and parsing resumes at the next row.
+        Returns (results, quality) where quality summarizes how well the layout fit:
+        kept rows, candidate rows (non-empty test name), score = kept / candidates,
+        and the footer cues that ended the table.
+        """
+        start_page = layout["start_page"]
+        header_bottom = layout["header_bottom"]
+        col_ranges = layout["col_ranges"]
+        row_threshold = layout["row_threshold"]
+        footer_keywords = tuple(set(self.FOOTER_KEYWORDS) | set(layout.get("footer_cues", [])))
+        quality = {"kept": 0, "candidates": 0, "footer_cues": []}
 
         results = []
+        rows_started = time.perf_counter()
         
         for p_idx, page in enumerate(doc.pages):
             if p_idx < start_page: continue
+            source_page = f"Page {p_idx+1}" # Shared by every row on the page
             
             words = [w for b in page.blocks for l in b.lines for w in l.words]
             words_below = [w for w in words if w.geometry[0][1] > header_bottom]
-            words_below.sort(key=lambda w: (w.geometry[0][1], w.geometry[0][0]))
-            
-            rows = []
-            if words_below:
-                current_row = [words_below[0]]
-                for w in words_below[1:]:
-                    if abs(w.geometry[0][1] - current_row[-1].geometry[0][1]) < row_threshold:
-                        current_row.append(w)
-                    else:
-                        rows.append(current_row)
-                        current_row = [w]
-                rows.append(current_row)
             
-            for row in rows:
+            for row in iter_lines(words_below, row_threshold):
                 row_cols = {"Test Name": [], "Value": [], "Unit": [], "Reference Range": []}
                 row_text_full = " ".join([w.value for w in row])
                 
                 # Check Footers
-                if "signature" in row_text_full.lower() or "professor" in row_text_full.lower():
+                row_lower = row_text_full.lower()
+                footer = next((k for k in footer_keywords if k in row_lower), None)
+                if footer:
+                     METRICS.inc("rows_rejected", reason="footer")
+                     trace.rejection(p_idx, row_text_full, "footer")
+                     if footer not in quality["footer_cues"]:
+                         quality["footer_cues"].append(footer)
                      break # Stop processing page on footer
                 
                 # Geometry Assignment
@@ -666,36 +1689,46 @@ class RobustOCR:
                 unit_text = " ".join(row_cols["Unit"])
                 ref_text = " ".join(row_cols["Reference Range"])
                 
+                # Interpretation / appendix text between or after the results
+                if self.is_appendix_line(row, val_text):
+                    METRICS.inc("rows_rejected", reason="appendix")
+                    trace.rejection(p_idx, row_text_full, "appendix")
+                    continue
+                
                 # BASE ENTRY
-                entry = {
-                    "Patient_ID": patient_id,
-                    "Patient_Name_Normalized": normalized_name,
-                    "Test_Code": None,
-                    "Test_Name_OCR": name_text,
-                    "Value": val_text,
-                    "Unit": unit_text,
-                    "Reference_Range": ref_text,
-                    "Value_Type": None,
-                    "Row_Type": "NOISE",
-                    "Reliability_Level": "LOW",
-                    "Source_Page": f"Page {p_idx+1}"
-                }
+                entry = ResultRecord(
+                    Patient_ID=patient_id,
+                    Patient_Name_Normalized=normalized_name,
+                    Test_Name_OCR=name_text,
+                    Value=val_text,
+                    Unit=unit_text,
+                    Reference_Range=ref_text,
+                    Row_Type="NOISE",
+                    Reliability_Level="LOW",
+                    Source_Page=source_page
+                )
                 
                 # Classification Logic
                 if not name_text:
+                    METRICS.inc("rows_rejected", reason="empty_name")
+                    trace.rejection(p_idx, row_text_full, "empty_name")
                     continue # Skip empty names
                 
+                quality["candidates"] += 1
                 clean_name = cleanup_name(name_text)
                 
                 # --- AGGRESSIVE NOISE FILTERING ---
-                if self.is_noise(clean_name):
-                    # print(f"Skipping noise row: {clean_name}") 
+                noise = self.noise_reason(clean_name)
+                if noise:
+                    # log.debug("Skipping noise row: %s", clean_name)
+                    METRICS.inc("rows_rejected", reason=noise)
+                    trace.rejection(p_idx, row_text_full, noise)
                     continue
                 # ----------------------------------
                 
                 norm_name = standardize_name(clean_name)
-                entry["Test_Name_OCR"] = clean_name # Keep the cleaner version
-                entry["Test_Code"] = norm_name if norm_name != clean_name.upper() else clean_name.upper()
+                entry.Test_Name_OCR = clean_name # Keep the cleaner version
+                entry.Test_Code = norm_name if norm_name != clean_name.upper() else clean_name.upper()
                 
                 # If standardiz_name returned the input upper-cased (no mapping),
                 # check if we should keep it. 
@@ -712,118 +1745,66 @@ class RobustOCR:
                         break
                 
                 if is_metadata:
-                    entry["Row_Type"] = "METADATA"
+                    entry.Row_Type = "METADATA"
+                    METRICS.inc("rows_rejected", reason="metadata")
+                    trace.rejection(p_idx, row_text_full, "metadata")
                     continue # Skip metadata rows in final output
 
                 # Data Validation
                 is_valid_val = re.search(r'\d+|negative|positive|reactive', val_text, re.I)
                 
                 if is_valid_val:
-                    entry["Row_Type"] = "DATA"
+                    entry.Row_Type = "DATA"
                     # Canonical Mapping
                     test_code = self.get_test_code(norm_name)
-                    entry["Test_Code"] = test_code
+                    entry.Test_Code = test_code
                     
                     # Value Type
                     if "%" in unit_text or "%" in val_text:
-                        entry["Value_Type"] = "PERCENT" 
+                        entry.Value_Type = "PERCENT" 
                     elif test_code in ["NEUT", "LYMPH", "MONO", "EO", "BASO"] and not "%" in unit_text:
-                         entry["Value_Type"] = "ABSOLUTE"
+                         entry.Value_Type = "ABSOLUTE"
                     else:
-                         entry["Value_Type"] = "PRIMARY"
+                         entry.Value_Type = "PRIMARY"
                     
                     # Reliability
                     val_confidences = [w.confidence for w in row if w.value in val_text.split()]
                     avg_conf = sum(val_confidences)/len(val_confidences) if val_confidences else 0.9
                     
-                    entry["Reliability_Level"] = self.get_reliability_level(round(avg_conf * 100, 2))
+                    entry.Reliability_Level = self.get_reliability_level(round(avg_conf * 100, 2))
                     
                     results.append(entry)
+                    quality["kept"] += 1
+                    METRICS.inc("rows_kept")
+                    if trace.enabled:
+                        trace.row(p_idx, text=row_text_full, **entry.to_dict())
+                else:
+                    METRICS.inc("rows_rejected", reason="no_value")
+                    trace.rejection(p_idx, row_text_full, "no_value")
         
-        return results, (patient_id, normalized_name)
+        METRICS.observe("row_extraction", time.perf_counter() - rows_started)
+        quality["score"] = quality["kept"] / quality["candidates"] if quality["candidates"] else 0.0
+        return results, quality
 
 
-if __name__ == "__main__":
-    
-    # Patient Manager
-    patient_manager = PatientManager()
-    
-    # Scan Input
-    if len(sys.argv) > 1:
-        target_file = sys.argv[1]
-        if os.path.exists(target_file):
-            # If full path given
-            pdf_files = [os.path.basename(target_file)]
-            # Ensure input dir matches or we adjust logic (script assumes INPUT_DIR)
-            # Simplest: assume user passes filename in input dir or we just use the name
-        elif os.path.exists(os.path.join(INPUT_DIR, target_file)):
-            pdf_files = [target_file]
-        else:
-            print(f"File {target_file} not found.")
-            sys.exit(1)
-    else:
-        pdf_files = [f for f in os.listdir(INPUT_DIR) if f.lower().endswith(".pdf")]
-    
-    if not pdf_files:
-        print(f"No PDF files found in {INPUT_DIR}")
-        sys.exit(0)
-        
-    print(f"Found {len(pdf_files)} PDFs to process.")
-    
-    ocr = RobustOCR()
-    
-    # Firebase Setup
-    try:
-        firebase_service = FirebaseService()
-    except Exception as e:
-        print(f"Firebase Init Failed: {e}")
-        firebase_service = None
-    
-    master_results = []
-    patient_registry = [] # List of tuples/dicts
-    
-    for pdf_file in pdf_files:
-        full_path = os.path.join(INPUT_DIR, pdf_file)
-        print(f"\n--- Processing {pdf_file} ---")
-        
-        # Process and collect results
-        file_results, patient_info = ocr.process_document(full_path, patient_manager)
-        
-        if file_results:
-            master_results.extend(file_results)
-            
-            # --- FIREBASE UPLOAD ---
-            # Structure data for this specific report
-            report_id = f"RPT_{patient_info[0]}_{int(pd.Timestamp.now().timestamp())}"
-            
-            p_data = {
-                "id": patient_info[0],
-                "name": patient_info[1]
-            }
-            
-            r_data = {
-                "id": report_id,
-                "sourceFile": pdf_file,
-                "timestamp": str(pd.Timestamp.now())
-            }
-            
-            # Use the new Firebase Service
-            # Note: We initialized 'firebase_service' outside the loop below
-            if 'firebase_service' in locals():
-                print(f"Uploading report {report_id} to Firebase...")
-                firebase_service.upload_report(p_data, r_data, file_results)
-            # -----------------------
-            
-        patient_registry.append({
-            "Patient_ID": patient_info[0],
-            "Patient_Name_Normalized": patient_info[1],
-            "Source_File": pdf_file
-        })
-        
+# ================= EXPORT =================
+
+def export_master(master_results, patient_registry):
+    """
+    Writes Master_Lab_Results.xlsx (Patients + Results sheets) and the
+    Flutter-facing per-patient JSON shards from all collected results.
+    """
+    import pandas as pd
+
+    master_results = as_records(master_results)
+
+    # Checkpoints written before flags existed
+    add_flags([r for r in master_results if not r.get("Flag")])
+
     # Export to Master Excel
     output_path = os.path.join(OUTPUT_DIR, "Master_Lab_Results.xlsx")
     
-    print(f"\nGeneratng Master Excel at {output_path}...")
+    log.info("Generating Master Excel at %s", output_path)
     
     try:
         with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
@@ -833,72 +1814,157 @@ if __name__ == "__main__":
             
             # Sheet 2: Results
             if master_results:
-                df_results = pd.DataFrame(master_results)
                 # Reorder columns for clarity
-                cols = ["Patient_ID", "Patient_Name_Normalized", "Test_Name_OCR", "Value", "Unit", "Reference_Range", "Value_Type", "Reliability_Level", "Source_Page"]
-                # Filter to only existing cols just in case
-                cols = [c for c in cols if c in df_results.columns]
-                df_results = df_results[cols]
+                cols = ["Patient_ID", "Patient_Name_Normalized", "Test_Name_OCR", "Value", "Unit", "Reference_Range", "Flag", "Value_Type", "Reliability_Level", "Source_Page"]
+                df_results = records_to_frame(master_results, cols)
                 
                 df_results.to_excel(writer, sheet_name="Results", index=False)
             else:
                 pd.DataFrame(["No Data Found"]).to_excel(writer, sheet_name="Results")
                 
-        print("Success! Master Excel created.")
+        log.info("Master Excel created")
 
         # ================= JSON EXPORT (FLUTTER) =================
-        json_output_path = os.path.join(OUTPUT_DIR, "Master_Lab_Results.json")
-        print(f"Generating Master JSON at {json_output_path}...")
+        # One shard per patient plus patients/index.json with content hashes,
+        # so the app only fetches changed patients. Master_Lab_Results.json
+        # is still written (spliced from the shards) unless OCR_MASTER_JSON=0.
+        shards_dir = os.path.join(OUTPUT_DIR, "patients")
+        combined_path = os.path.join(OUTPUT_DIR, "Master_Lab_Results.json") if MASTER_JSON else None
+        log.info("Generating patient JSON shards in %s", shards_dir)
 
-        # Structure data for Flutter (Hierarchical: Patient -> Results)
-        # Use camelCase for keys to match standard Dart/Flutter models
-        
-        json_data = {
-            "metadata": {
-                "exportDate": pd.Timestamp.now().isoformat(),
-                "totalPatients": 0,
-                "totalTests": len(master_results)
-            },
-            "patients": []
-        }
+        export_shards(master_results, patient_registry, shards_dir, combined_path)
+
+    except Exception:
+        log.exception("Error saving export")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Extract lab results from PDFs in input/ into Excel/JSON.")
+    parser.add_argument("file", nargs="?", help="Single PDF to process (path or name in input/). Default: all PDFs in input/")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default=DEFAULT_PROFILE, help="Speed/accuracy profile")
+    parser.add_argument("--backend", choices=OCR_BACKENDS, default=None, help="Inference backend (default: OCR_BACKEND or torch)")
+    parser.add_argument("--full", action="store_true", help="Reprocess every file, ignoring the processed-files manifest")
+    parser.add_argument("--watch", action="store_true", help="Keep running and process PDFs as they land in input/")
+    parser.add_argument("--interval", type=float, default=5.0, help="Watch mode rescan interval in seconds")
+    args = parser.parse_args()
+
+    import pandas as pd
+    from firebase_service import FirebaseService
+    from sync_manifest import SyncManifest, watch_directory
+    from results_store import ResultsStore
+    setup_logging()
+    ensure_dirs()
+    
+    # Patient Manager
+    patient_manager = PatientManager()
+
+    # Processed-files manifest + per-document checkpoints (incremental, crash-safe runs)
+    manifest = SyncManifest(
+        os.path.join(OUTPUT_DIR, "processed_manifest.json"),
+        os.path.join(OUTPUT_DIR, "checkpoints"),
+        PIPELINE_VERSION
+    )
+    # Partitioned Parquet dataset: system of record, Excel/JSON are views
+    results_store = ResultsStore(os.path.join(OUTPUT_DIR, "results_parquet"))
+    
+    # Scan Input
+    def list_inputs():
+        """
+        Returns [(manifest_key, full_path)] for the requested file or all PDFs in input/.
+        """
+        if args.file:
+            target_file = args.file
+            if os.path.exists(os.path.join(INPUT_DIR, target_file)):
+                return [(target_file, os.path.join(INPUT_DIR, target_file))]
+            if os.path.exists(target_file):
+                # If full path given
+                return [(os.path.abspath(target_file), os.path.abspath(target_file))]
+            print(f"File {target_file} not found.")
+            sys.exit(1)
+        return [(f, os.path.join(INPUT_DIR, f)) for f in sorted(os.listdir(INPUT_DIR)) if f.lower().endswith(".pdf")]
+    
+    ocr = None
+    firebase_service = None
+
+    def sync_once(settle_seconds=0):
+        """
+        Processes new/changed inputs, checkpointing after each document,
+        then rebuilds the exports from every checkpoint. Returns files processed.
+        """
+        global ocr, firebase_service
+        inputs = list_inputs()
+        force = args.full or bool(args.file)
+        todo = []
+        for key, full_path in inputs:
+            needed, sha = manifest.needs_processing(key, full_path, settle_seconds)
+            if force and not needed:
+                sha = file_sha256(full_path)
+                needed = True
+            if needed:
+                todo.append((key, full_path, sha))
+
+        if not todo:
+            return 0
+        print(f"Found {len(todo)} new or changed PDFs to process ({len(inputs) - len(todo)} up to date).")
+
+        if ocr is None:
+            ocr = RobustOCR(backend=args.backend, profile=args.profile)
+            # Firebase Setup
+            try:
+                firebase_service = FirebaseService()
+            except Exception as e:
+                print(f"Firebase Init Failed: {e}")
+                firebase_service = None
 
-        # Group by Patient_ID
-        patients_dict = {}
-        for p in patient_registry:
-            pid = p["Patient_ID"]
-            if pid not in patients_dict:
-                patients_dict[pid] = {
-                    "id": pid,
-                    "name": p["Patient_Name_Normalized"],
-                    "sourceFiles": [],
-                    "results": []
+        for key, full_path, sha in todo:
+            pdf_file = os.path.basename(full_path)
+            print(f"\n--- Processing {pdf_file} ---")
+            
+            # Process and collect results
+            try:
+                file_results, patient_info = ocr.process_document(full_path, patient_manager)
+            except Exception as e:
+                print(f"Error processing {pdf_file}: {e}")
+                manifest.record_failure(key, full_path, sha, e)
+                continue
+            
+            report_id = f"RPT_{patient_info[0] if patient_info else 'UNKNOWN'}_{uuid.uuid4().hex[:16]}"
+            if file_results:
+                # --- FIREBASE UPLOAD ---
+                # Structure data for this specific report
+                
+                p_data = {
+                    "id": patient_info[0],
+                    "name": patient_info[1]
                 }
-            if p["Source_File"] not in patients_dict[pid]["sourceFiles"]:
-                patients_dict[pid]["sourceFiles"].append(p["Source_File"])
-
-        # Add results to patients
-        for res in master_results:
-            pid = res["Patient_ID"]
-            if pid in patients_dict:
-                test_entry = {
-                    "testName": res["Test_Name_OCR"],
-                    "testCode": res["Test_Code"],
-                    "value": res["Value"],
-                    "unit": res["Unit"],
-                    "referenceRange": res["Reference_Range"],
-                    "type": res["Value_Type"],
-                    "reliability": res["Reliability_Level"],
-                    "page": res["Source_Page"]
+                
+                r_data = {
+                    "id": report_id,
+                    "sourceFile": pdf_file,
+                    "timestamp": str(pd.Timestamp.now())
                 }
-                patients_dict[pid]["results"].append(test_entry)
+                
+                if firebase_service:
+                    print(f"Uploading report {report_id} to Firebase...")
+                    firebase_service.upload_report(p_data, r_data, file_results)
+                # -----------------------
 
-        json_data["patients"] = list(patients_dict.values())
-        json_data["metadata"]["totalPatients"] = len(json_data["patients"])
+            # Checkpoint: an interrupted run resumes after this document
+            previous_sha = manifest.entries.get(key, {}).get("sha256")
+            results_store.append(file_results, sha[:16], key, report_id,
+                                 replaces=previous_sha[:16] if previous_sha and previous_sha != sha else None)
+            manifest.record(key, full_path, sha, file_results, patient_info)
 
-        with open(json_output_path, "w", encoding="utf-8") as f:
-            json.dump(json_data, f, indent=2, ensure_ascii=False)
-        
-        print("Success! Master JSON created.")
-        
-    except Exception as e:
-        print(f"Error saving Export: {e}")
+        master_results, patient_registry = manifest.collect()
+        export_master(master_results, patient_registry)
+        return len(todo)
+
+    if args.watch:
+        watch_directory(INPUT_DIR, lambda: sync_once(settle_seconds=2), interval=args.interval)
+    else:
+        if not list_inputs():
+            print(f"No PDF files found in {INPUT_DIR}")
+            sys.exit(0)
+        if not sync_once():
+            print("All PDFs are up to date. Use --full to reprocess.")
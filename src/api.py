@@ -1,10 +1,21 @@
 import os
-from flask import Flask, request, jsonify # type: ignore
+import json
+import base64
+import threading
+import time
+import io
+import tempfile
+from flask import Flask, Request, request, jsonify, Response # type: ignore
+from werkzeug.exceptions import RequestEntityTooLarge # type: ignore
 from werkzeug.utils import secure_filename # type: ignore
-import pandas as pd # type: ignore
-from OCR_robust import RobustOCR, PatientManager
+import uuid
+from datetime import datetime
+from OCR_robust import RobustOCR, PatientManager, PROFILES
+from metrics import METRICS
+from tracing import log, setup_logging
+from results_store import ResultsStore, RESULT_COLUMNS
 
-app = Flask(__name__)
+setup_logging()
 
 # --- Configuration ---
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "input")
@@ -12,13 +23,195 @@ OUTPUT_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__f
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+# Upload limits: per file, per request (batch) and files per batch
+MAX_FILE_MB = float(os.environ.get("OCR_MAX_FILE_MB", "16"))
+MAX_BATCH_MB = float(os.environ.get("OCR_MAX_BATCH_MB", "128"))
+MAX_FILE_BYTES = int(MAX_FILE_MB * 1024 * 1024)
+MAX_BATCH_BYTES = int(MAX_BATCH_MB * 1024 * 1024)
+MAX_BATCH_FILES = int(os.environ.get("OCR_MAX_BATCH_FILES", "30"))
+
+class FileTooLarge(RequestEntityTooLarge):
+    description = f"File exceeds the {MAX_FILE_MB:g} MB per-file limit"
+
+class UploadFile(io.FileIO):
+    """
+    Upload part streamed straight into UPLOAD_FOLDER while the multipart body
+    is parsed. Aborts with 413 (and deletes itself) past MAX_FILE_BYTES.
+    """
+    def __init__(self):
+        fd, path = tempfile.mkstemp(prefix=".upload_", suffix=".part", dir=UPLOAD_FOLDER)
+        os.close(fd)
+        super().__init__(path, "w+b")
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        if self.written > MAX_FILE_BYTES:
+            self.discard()
+            raise FileTooLarge()
+        return super().write(data)
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.name):
+            os.remove(self.name)
+
+class UploadRequest(Request):
+    """
+    Streams every file part to an UploadFile and remembers it, so parts that
+    were not stored (errors, extra fields, a 413 mid-batch) are removed when
+    the request ends.
+    """
+    max_form_parts = MAX_BATCH_FILES + 20 # Files plus a few form fields
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_parts = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        part = UploadFile()
+        self.upload_parts.append(part)
+        return part
+
+app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
+app.config['MAX_CONTENT_LENGTH'] = MAX_BATCH_BYTES
 
 # Init OCR & Patient Sync
 ocr = RobustOCR()
 patient_manager = PatientManager()
 
+# Results are appended to a partitioned Parquet dataset. With OCR_EXCEL_VIEW=1
+# an Excel workbook is also rebuilt from it in the background after uploads;
+# the rebuild reads the whole dataset, so it is off by default.
+results_store = ResultsStore(os.path.join(OUTPUT_FOLDER, "results_parquet"))
+EXCEL_VIEW = os.environ.get("OCR_EXCEL_VIEW", "0") == "1"
+EXCEL_VIEW_PATH = os.path.join(OUTPUT_FOLDER, "Master_Lab_Results.xlsx")
+excel_view_state = {"running": False, "pending": False}
+excel_view_lock = threading.Lock()
+
+def rebuild_excel_view():
+    """
+    Schedules a background rebuild of the Excel view. Uploads arriving while
+    one runs collapse into a single follow-up rebuild. Failures are logged
+    only: the rows are already stored in the dataset.
+    """
+    with excel_view_lock:
+        if excel_view_state["running"]:
+            excel_view_state["pending"] = True
+            return
+        excel_view_state["running"] = True
+    threading.Thread(target=excel_view_worker, name="excel-view", daemon=True).start()
+
+def excel_view_worker():
+    while True:
+        try:
+            results_store.export_excel(EXCEL_VIEW_PATH)
+        except Exception:
+            log.exception("Excel view rebuild failed (%s)", EXCEL_VIEW_PATH)
+        with excel_view_lock:
+            if not excel_view_state["pending"]:
+                excel_view_state["running"] = False
+                return
+            excel_view_state["pending"] = False
+
+# --- Warm-up ---
+# Models load in the background; /health answers immediately, /ready only once
+# the models are in memory. Set OCR_WARMUP=0 to load lazily on the first upload;
+# /ready then reports ready right away (status "lazy") so it can still gate traffic.
+WARMUP_ENABLED = os.environ.get("OCR_WARMUP", "1") != "0"
+warmup_state = {"status": "warming_up" if WARMUP_ENABLED else "lazy", "error": None}
+
+def warm_up():
+    try:
+        # OCR_WARMUP_PROFILES=fast,accurate preloads extra profiles besides the default
+        extra = [p for p in os.environ.get("OCR_WARMUP_PROFILES", "").split(",") if p in PROFILES and p != ocr.profile]
+        with METRICS.stage("warm_up"):
+            ocr.warm_up([ocr.profile] + extra)
+        warmup_state["status"] = "ready"
+    except Exception as e:
+        log.error("Warm-up failed: %s", e)
+        warmup_state["status"] = "failed"
+        warmup_state["error"] = str(e)
+
+# With the debug reloader (python api.py) this module also runs in the file
+# watcher process, which never serves requests: only the serving child
+# (WERKZEUG_RUN_MAIN set) loads the models
+RELOADER_PARENT = __name__ == '__main__' and os.environ.get("WERKZEUG_RUN_MAIN") != "true"
+if WARMUP_ENABLED and not RELOADER_PARENT:
+    threading.Thread(target=warm_up, name="ocr-warm-up", daemon=True).start()
+
+def store_upload(file):
+    """
+    Moves a streamed upload to a unique name in UPLOAD_FOLDER; returns that name.
+    """
+    base, ext = os.path.splitext(secure_filename(file.filename) or "upload")
+    unique_filename = f"{base}_{int(time.time())}_{uuid.uuid4().hex[:8]}{ext.lower()}"
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+    if isinstance(file.stream, UploadFile):
+        file.stream.close()
+        os.replace(file.stream.name, filepath)
+    else:
+        file.save(filepath)
+    return unique_filename
+
+@app.teardown_request
+def discard_uploads(exc=None):
+    # Parts moved into place by store_upload no longer exist under their temp name
+    for part in getattr(request, "upload_parts", []):
+        part.discard()
+
+def requested_profile():
+    # Optional speed/accuracy profile (form field or query string), e.g. "fast" for interactive uploads
+    profile = request.form.get('profile') or request.args.get('profile')
+    if profile and profile not in PROFILES:
+        return profile, (jsonify({"error": f"Unknown profile '{profile}'", "profiles": sorted(PROFILES)}), 400)
+    return profile, None
+
+def process_and_store(source, source_name, profile):
+    """
+    Runs one (possibly multi-page) report through OCR and persists the rows.
+    source is a file path or a list of page files. Returns a Flask response.
+    """
+    try:
+        with METRICS.stage("process_document"):
+            file_results, patient_info = ocr.process_document(source, patient_manager, profile=profile)
+        
+        if not file_results:
+             METRICS.inc("uploads", status="empty")
+             return jsonify({
+                "message": "Processed but no data extracted.",
+                "patient_id": patient_info[0] if patient_info else "UNKNOWN",
+                "patient_name": patient_info[1] if patient_info else "UNKNOWN"
+            }), 200
+
+        # Append to the Parquet dataset (system of record); Excel is a rebuilt view
+        # Unique per upload: two reports for one patient in the same second must not share an index entry
+        doc_id = uuid.uuid4().hex[:16]
+        report_id = f"RPT_{patient_info[0]}_{doc_id}"
+        
+        with METRICS.stage("persistence"):
+            results_store.append(file_results, doc_id, source_name, report_id)
+        if EXCEL_VIEW:
+            rebuild_excel_view()
+
+        METRICS.inc("uploads", status="success")
+        return jsonify({
+            "message": "Success",
+            "patient_id": patient_info[0],
+            "patient_name": patient_info[1],
+            "report_id": report_id,
+            "extracted_count": len(file_results),
+            "excel_path": EXCEL_VIEW_PATH if EXCEL_VIEW else None,
+            "dataset_path": results_store.root
+        }), 200
+        
+    except Exception as e:
+        log.exception("Error processing %s", source_name)
+        METRICS.inc("uploads", status="error")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/upload_report', methods=['POST'])
 def upload_report():
     if 'file' not in request.files:
@@ -28,65 +221,197 @@ def upload_report():
     
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
+
+    profile, error = requested_profile()
+    if error:
+        return error
         
-    if file:
-        filename = secure_filename(file.filename)
-        # Unique filename
-        base, ext = os.path.splitext(filename)
-        import time
-        unique_filename = f"{base}_{int(time.time())}{ext}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(filepath)
-        
-        try:
-            # Process the image
-            print(f"Processing upload: {filepath}")
-            # Note: OCR_robust expects a file path or list
-            file_results, patient_info = ocr.process_document(filepath, patient_manager)
-            
-            if not file_results:
-                 return jsonify({
-                    "message": "Processed but no data extracted.",
-                    "patient_id": patient_info[0] if patient_info else "UNKNOWN",
-                    "patient_name": patient_info[1] if patient_info else "UNKNOWN"
-                }), 200
-
-            # Append to Excel (reusing logic from main block of OCR_robust.py but cleaner)
-            output_path = os.path.join(OUTPUT_FOLDER, "Master_Lab_Results.xlsx")
-            
-            new_df = pd.DataFrame(file_results)
-            
-            if os.path.exists(output_path):
-                try:
-                    existing_df = pd.read_excel(output_path)
-                    final_df = pd.concat([existing_df, new_df], ignore_index=True)
-                except Exception as e:
-                    print(f"Error reading existing Excel: {e}")
-                    final_df = new_df
-            else:
-                final_df = new_df
-                
-            # Save updated Excel
-            with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-                # Add patient sheet if possible (simplified here to just results)
-                final_df.to_excel(writer, sheet_name="All_Results", index=False)
-                
-            return jsonify({
-                "message": "Success",
-                "patient_id": patient_info[0],
-                "patient_name": patient_info[1],
-                "extracted_count": len(file_results),
-                "excel_path": output_path
-            }), 200
-            
-        except Exception as e:
-            print(f"Error processing file: {e}")
-            return jsonify({"error": str(e)}), 500
+    unique_filename = store_upload(file)
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+    log.info("Processing upload: %s", filepath)
+    return process_and_store(filepath, unique_filename, profile)
+
+@app.route('/upload_batch', methods=['POST'])
+def upload_batch():
+    """
+    Several files (form field "files", in page order) forming one report,
+    e.g. one photo per page. They are OCR'd as a single document: one
+    inference batch, one patient-name extraction, one report.
+    """
+    files = [f for f in request.files.getlist('files') if f.filename]
+    if not files:
+        return jsonify({"error": "No files"}), 400
+    if len(files) > MAX_BATCH_FILES:
+        return jsonify({"error": f"Too many files ({len(files)}), limit is {MAX_BATCH_FILES}"}), 400
+
+    profile, error = requested_profile()
+    if error:
+        return error
+
+    names = [store_upload(f) for f in files]
+    paths = [os.path.join(app.config['UPLOAD_FOLDER'], n) for n in names]
+    log.info("Processing batch of %d files: %s ...", len(paths), names[0])
+    METRICS.inc("batch_files", len(paths))
+    return process_and_store(paths, names[0], profile)
+
+@app.errorhandler(RequestEntityTooLarge)
+def too_large(e):
+    METRICS.inc("uploads", status="too_large")
+    return jsonify({
+        "error": e.description if isinstance(e, FileTooLarge)
+                 else f"Request exceeds the {MAX_BATCH_MB:g} MB batch limit",
+        "max_file_mb": MAX_FILE_MB,
+        "max_batch_mb": MAX_BATCH_MB
+    }), 413
+
+# --- Read API ---
+# Served from the Parquet dataset. Responses carry an ETag derived from the
+# files backing them, so clients polling with If-None-Match get a 304 without
+# any data being read.
+# Rows are ordered newest report first, then by their order within the report.
+# The cursor is the (Processed_At, Report_ID, row) key of the last row sent, so
+# uploads between page fetches never shift rows, and later pages only read
+# data up to that timestamp. "total" is only reported on the first page.
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(row):
+    key = {"t": row["Processed_At"].isoformat(), "r": row["Report_ID"], "n": int(row["_row"])}
+    return base64.urlsafe_b64encode(json.dumps(key).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    """
+    (Processed_At, Report_ID, row) from a cursor, or None for the first page.
+    """
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        processed_at = datetime.fromisoformat(key["t"])
+        if processed_at.tzinfo is None:
+            raise ValueError
+        return processed_at, str(key["r"]), int(key["n"])
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def parse_limit(value):
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("limit must be an integer")
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    return min(limit, MAX_PAGE_SIZE)
+
+def ordered(df):
+    """
+    Sorts rows newest report first, keeping each report's stored row order
+    (numbered in _row).
+    """
+    df = df.assign(Report_ID=df["Report_ID"].fillna(""))
+    df["_row"] = df.groupby("Report_ID", sort=False).cumcount()
+    return df.sort_values(["Processed_At", "Report_ID", "_row"], ascending=[False, True, True], kind="stable")
+
+def after_cursor(df, cursor):
+    processed_at, report_id, row = cursor
+    ts = df["Processed_At"]
+    same = ts == processed_at
+    return df[(ts < processed_at)
+              | (same & (df["Report_ID"] > report_id))
+              | (same & (df["Report_ID"] == report_id) & (df["_row"] > row))]
+
+def records_of(df):
+    df = df.drop(columns=["_row"], errors="ignore")
+    df["Processed_At"] = df["Processed_At"].map(lambda t: t.isoformat())
+    return df.astype(object).where(df.notna(), None).to_dict(orient="records")
+
+def not_modified(etag):
+    return etag in request.if_none_match
+
+def with_etag(payload, etag):
+    resp = jsonify(payload)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+def paged_results(etag, patient_id, test_code=None):
+    try:
+        cursor = decode_cursor(request.args.get("cursor"))
+        limit = parse_limit(request.args.get("limit", PAGE_SIZE))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    since = request.args.get("since")
+    with METRICS.stage("read_results"):
+        df = results_store.read(patient_id=patient_id, test_code=test_code, since=since, columns=RESULT_COLUMNS,
+                                until=cursor[0] if cursor else None)
+    df = ordered(df)
+    total = len(df) if cursor is None else None
+    if cursor is not None:
+        df = after_cursor(df, cursor)
+    page = df.iloc[:limit]
+    return with_etag({
+        "patient_id": patient_id,
+        "test_code": test_code,
+        "total": total,
+        "results": records_of(page),
+        "next_cursor": encode_cursor(page.iloc[-1]) if len(df) > limit else None
+    }, etag)
+
+@app.route('/patients/<patient_id>/results', methods=['GET'])
+def patient_results(patient_id):
+    etag = results_store.version(patient_id)
+    if not_modified(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    return paged_results(etag, patient_id)
+
+@app.route('/patients/<patient_id>/tests/<test_code>', methods=['GET'])
+def patient_test_results(patient_id, test_code):
+    etag = results_store.version(patient_id)
+    if not_modified(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    return paged_results(etag, patient_id, test_code)
+
+@app.route('/reports/<report_id>', methods=['GET'])
+def report(report_id):
+    entry = results_store.report_entry(report_id)
+    if entry is None:
+        return jsonify({"error": "Report not found"}), 404
+    etag = results_store.version(entry["patient_id"])
+    if not_modified(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    entry, df = results_store.read_report(report_id, columns=RESULT_COLUMNS)
+    if entry is None:
+        return jsonify({"error": "Report not found"}), 404
+    return with_etag({
+        "report_id": report_id,
+        "patient_id": entry["patient_id"],
+        "source_file": entry["source_file"],
+        "processed_at": entry["processed_at"],
+        "results": records_of(ordered(df))
+    }, etag)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({"status": "running"}), 200
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    if ocr.is_ready():
+        return jsonify({"status": "ready"}), 200
+    if not WARMUP_ENABLED:
+        # Nothing will load until an upload arrives, so don't hold traffic back
+        return jsonify(warmup_state), 200
+    return jsonify(warmup_state), 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Stage latency summaries (p50/p90/p99) and pipeline counters in Prometheus text format.
+    """
+    return Response(METRICS.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == '__main__':
     # Run on 0.0.0.0 to be accessible from other devices on the network
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # RobustOCR, PatientManager and ResultsStore are safe to share across request threads
+    app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
@@ -3,6 +3,7 @@ from firebase_admin import credentials, firestore
 import os
 import json
 from datetime import datetime
+from reference_ranges import flag_value
 
 class FirebaseService:
     def __init__(self, cred_path=None):
@@ -56,7 +57,7 @@ class FirebaseService:
             }, merge=True)
 
             # 2. Prepare Report
-            report_data = report_data.get("id")
+            report_id = report_data.get("id")
             results_map = {}
             
             # Convert list of results to a map keyed by Test Code (or Name)
@@ -72,7 +73,7 @@ class FirebaseService:
                     "unit": res.get("Unit"),
                     "ref_range": res.get("Reference_Range"),
                     "reliability": res.get("Reliability_Level"),
-                    "flag": res.get("Flag", "Normal") # Assuming you might add flags later
+                    "flag": res.get("Flag") or flag_value(res.get("Value"), res.get("Reference_Range"))
                 }
 
             report_payload = {
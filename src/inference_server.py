@@ -0,0 +1,402 @@
+"""
+Local inference daemon: one copy of the docTR and EasyOCR models shared by
+every API worker on the machine.
+
+Workers connect over a Unix socket (RobustOCR(backend="remote") or
+OCR_BACKEND=remote) and send page arrays. Requests that arrive within a short
+window are micro-batched into a single model call.
+
+Usage:
+    python src/inference_server.py [--socket /tmp/ocr_inference.sock]
+                                   [--backend torch] [--profiles accurate fast]
+                                   [--window-ms 10] [--max-batch 16]
+"""
+import os
+import copy
+import sys
+import json
+import time
+import queue
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from OCR_robust import (  # noqa: E402
+    RobustOCR, PROFILES, OCR_BACKENDS, build_predictor, get_profile,
+    OCRWord, OCRLine, OCRBlock, OCRPage, OCRDocument
+)
+from metrics import METRICS  # noqa: E402
+from tracing import log, setup_logging  # noqa: E402
+
+DEFAULT_SOCKET = os.environ.get("OCR_INFERENCE_SOCKET", "/tmp/ocr_inference.sock")
+BATCH_WINDOW_MS = float(os.environ.get("OCR_BATCH_WINDOW_MS", "10"))
+MAX_BATCH = int(os.environ.get("OCR_MAX_BATCH", "16"))
+
+# ================= WIRE PROTOCOL =================
+# Frame: 4-byte header length, JSON header, then the raw bytes of each array
+# listed in header["arrays"] (shape/dtype). No pickle: only JSON and buffers.
+
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    while n:
+        got = sock.recv_into(view, n)
+        if not got:
+            raise ConnectionError("Connection closed")
+        view, n = view[got:], n - got
+    return buf
+
+
+def send_message(sock, header, arrays=()):
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    header = dict(header, arrays=[{"shape": a.shape, "dtype": a.dtype.str} for a in arrays])
+    raw = json.dumps(header, default=_jsonable).encode("utf-8")
+    sock.sendall(struct.pack("!I", len(raw)) + raw)
+    for a in arrays:
+        sock.sendall(memoryview(a).cast("B"))
+
+
+def recv_message(sock):
+    (size,) = struct.unpack("!I", _recv_exact(sock, 4))
+    header = json.loads(_recv_exact(sock, size))
+    arrays = []
+    for spec in header.pop("arrays"):
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"])) if spec["shape"] else 1
+        arrays.append(np.frombuffer(_recv_exact(sock, count * dtype.itemsize), dtype).reshape(spec["shape"]))
+    return header, arrays
+
+
+def _jsonable(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Not JSON serializable: {type(obj).__name__}")
+
+
+def _geometry_in(geom):
+    # Straight boxes are ((x0, y0), (x1, y1)); rotated boxes are 4-point polygons
+    return np.array(geom) if len(geom) > 2 else tuple(tuple(p) for p in geom)
+
+
+def document_to_wire(doc):
+    """
+    docTR Document (or OCRDocument) -> JSON-able pages/blocks/lines/words.
+    """
+    return [{
+        "dimensions": list(page.dimensions),
+        "blocks": [{
+            "geometry": b.geometry,
+            "lines": [{
+                "geometry": l.geometry,
+                "words": [[w.value, float(w.confidence), w.geometry] for w in l.words]
+            } for l in b.lines]
+        } for b in page.blocks]
+    } for page in doc.pages]
+
+
+def document_from_wire(pages):
+    return OCRDocument([
+        OCRPage([
+            OCRBlock(_geometry_in(b["geometry"]), [
+                OCRLine(_geometry_in(l["geometry"]),
+                        [OCRWord(v, c, _geometry_in(g)) for v, c, g in l["words"]])
+                for l in b["lines"]
+            ]) for b in p["blocks"]
+        ], tuple(p["dimensions"])) for p in pages
+    ])
+
+# ================= CLIENT =================
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client(socket_path=None):
+    """
+    Process-wide InferenceClient used by the "remote" backend.
+    """
+    global _client
+    with _client_lock:
+        if _client is None or (socket_path and _client.socket_path != socket_path):
+            _client = InferenceClient(socket_path)
+        return _client
+
+
+class InferenceClient:
+    """
+    Thread-safe client: one persistent connection per calling thread,
+    reconnecting once if the daemon restarted.
+    """
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or DEFAULT_SOCKET
+        self.local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        self.local.sock = sock
+        return sock
+
+    def call(self, op, arrays=(), **args):
+        for attempt in (0, 1):
+            sock = getattr(self.local, "sock", None)
+            try:
+                if sock is None:
+                    sock = self._connect()
+                send_message(sock, {"op": op, "args": args}, arrays)
+                header, out = recv_message(sock)
+                break
+            except (ConnectionError, OSError) as e:
+                self.local.sock = None
+                if sock is not None:
+                    sock.close()
+                if attempt:
+                    raise ConnectionError(f"OCR inference server unavailable at {self.socket_path}: {e}") from e
+        if not header["ok"]:
+            raise RuntimeError(f"Inference server error: {header['error']}")
+        return header["result"], out
+
+
+class RemotePredictor:
+    """
+    Stand-in for a docTR ocr_predictor that runs on the inference daemon.
+    Supports predictor(pages), .det_predictor(pages) and .reco_predictor(crops);
+    copy.copy() + detect_orientation=False works as with the local predictor.
+    """
+    def __init__(self, client, det_arch, reco_arch, detect_orientation=False):
+        self.client = client
+        self.det_arch = det_arch
+        self.reco_arch = reco_arch
+        self.detect_orientation = detect_orientation
+        # Loads the models on the daemon (warm-up) and fails fast if it is down
+        self.client.call("load", det_arch=det_arch, reco_arch=reco_arch, detect_orientation=detect_orientation)
+
+    def _args(self):
+        return {"det_arch": self.det_arch, "reco_arch": self.reco_arch, "detect_orientation": self.detect_orientation}
+
+    def __call__(self, pages):
+        result, _ = self.client.call("ocr", pages, **self._args())
+        return document_from_wire(result)
+
+    def det_predictor(self, pages):
+        result, _ = self.client.call("det", pages, **self._args())
+        return [np.asarray(boxes, dtype=float).reshape(-1, 4) for boxes in result]
+
+    def reco_predictor(self, crops):
+        result, _ = self.client.call("reco", crops, **self._args())
+        return [tuple(r) for r in result]
+
+
+class RemoteNameReader:
+    """
+    Stand-in for easyocr.Reader(['ar', 'en']) on the inference daemon.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.client.call("load_name_reader")
+
+    def readtext(self, img, detail=1, paragraph=False):
+        result, _ = self.client.call("readtext", [img], detail=detail, paragraph=paragraph)
+        return result[0]
+
+# ================= SERVER =================
+
+class MicroBatcher:
+    """
+    Runs every model call on one thread. Jobs arriving within window_ms of
+    the first queued job (up to max_batch items per key) are grouped by key
+    and each group is executed as one batch.
+    """
+    def __init__(self, execute, window_ms=BATCH_WINDOW_MS, max_batch=MAX_BATCH):
+        self.execute = execute # execute(key, [items...]) -> [result per item]
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.jobs = queue.Queue()
+        threading.Thread(target=self.run, name="ocr-batcher", daemon=True).start()
+
+    def submit(self, key, items):
+        """
+        Blocks until the items were processed; returns their results in order.
+        """
+        job = {"key": key, "items": items, "done": threading.Event(), "result": None, "error": None}
+        self.jobs.put(job)
+        job["done"].wait()
+        if job["error"] is not None:
+            raise job["error"]
+        return job["result"]
+
+    def run(self):
+        while True:
+            pending = [self.jobs.get()]
+            deadline = time.perf_counter() + self.window
+            size = len(pending[0]["items"])
+            while size < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    job = self.jobs.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                pending.append(job)
+                size += len(job["items"])
+
+            groups = {}
+            for job in pending:
+                groups.setdefault(job["key"], []).append(job)
+            for key, jobs in groups.items():
+                items = [item for job in jobs for item in job["items"]]
+                METRICS.inc("inference_batches", op=key[0])
+                METRICS.inc("inference_batch_items", len(items), op=key[0])
+                try:
+                    results = self.execute(key, items)
+                    pos = 0
+                    for job in jobs:
+                        job["result"] = results[pos:pos + len(job["items"])]
+                        pos += len(job["items"])
+                except Exception as e:
+                    for job in jobs:
+                        job["error"] = e
+                for job in jobs:
+                    job["done"].set()
+
+
+class InferenceServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Unix-socket server holding the models. Each connection gets a thread that
+    decodes requests and hands them to the MicroBatcher.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, backend=None, quantized=None, window_ms=BATCH_WINDOW_MS, max_batch=MAX_BATCH):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.ocr = RobustOCR(backend=backend, quantized=quantized, templates=False)
+        if self.ocr.backend == "remote":
+            raise ValueError("The inference server needs a local backend (torch or onnx)")
+        self.models = {} # { (det_arch, reco_arch, detect_orientation): predictor }
+        self.model_lock = threading.Lock()
+        self.batcher = MicroBatcher(self.execute, window_ms, max_batch)
+        super().__init__(socket_path, InferenceHandler)
+        os.chmod(socket_path, 0o600) # Local workers of the same user only
+
+    def predictor(self, det_arch, reco_arch, detect_orientation):
+        """
+        One det/reco model set per architecture pair. The orientation-free
+        predictor is a shallow copy of the orientation-enabled one when that is
+        loaded (same models, orientation step off), as in RobustOCR.get_predictor.
+        """
+        key = (det_arch, reco_arch, bool(detect_orientation))
+        if key not in self.models:
+            with self.model_lock:
+                if key not in self.models:
+                    full_key = (det_arch, reco_arch, True)
+                    if not key[2] and full_key in self.models:
+                        self.models[key] = self.upright_variant(self.models[full_key])
+                    else:
+                        log.info("Loading %s predictor %s/%s (orientation=%s)", self.ocr.backend, *key)
+                        with METRICS.stage("model_load"):
+                            self.models[key] = build_predictor(self.ocr.backend, self.ocr.quantized, det_arch=det_arch,
+                                                               reco_arch=reco_arch, detect_orientation=key[2])
+                        upright_key = (det_arch, reco_arch, False)
+                        if key[2] and upright_key in self.models:
+                            # Drop the separately loaded models; the variant shares the new ones
+                            self.models[upright_key] = self.upright_variant(self.models[key])
+        return self.models[key]
+
+    @staticmethod
+    def upright_variant(predictor):
+        variant = copy.copy(predictor)
+        variant.detect_orientation = False
+        return variant
+
+    def execute(self, key, items):
+        op, args = key[0], dict(key[1:])
+        if op == "readtext":
+            reader = self.ocr.get_name_reader()
+            with METRICS.stage("inference_readtext"):
+                return [reader.readtext(img, **args) for img in items]
+
+        predictor = self.predictor(**args)
+        with METRICS.stage(f"inference_{op}"):
+            if op == "ocr":
+                return document_to_wire(predictor(items))
+            if op == "det":
+                from OCR_robust import detection_boxes
+                return [detection_boxes(out) for out in predictor.det_predictor(items)]
+            if op == "reco":
+                return [(value, float(conf)) for value, conf in predictor.reco_predictor(items)]
+        raise ValueError(f"Unknown op '{op}'")
+
+
+class InferenceHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                header, arrays = recv_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            op, args = header["op"], header.get("args", {})
+            try:
+                if op == "load":
+                    self.server.predictor(**args)
+                    result = None
+                elif op == "load_name_reader":
+                    self.server.ocr.get_name_reader()
+                    result = None
+                elif op == "stats":
+                    result = {"pid": os.getpid(), "metrics": METRICS.render_prometheus()}
+                else:
+                    key = (op,) + tuple(sorted(args.items()))
+                    result = self.server.batcher.submit(key, arrays)
+                reply = {"ok": True, "result": result}
+            except Exception as e:
+                log.error("Inference request %s failed: %s", op, e)
+                reply = {"ok": False, "error": str(e)}
+            try:
+                send_message(self.request, reply)
+            except (ConnectionError, OSError):
+                return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket path (OCR_INFERENCE_SOCKET)")
+    parser.add_argument("--backend", choices=[b for b in OCR_BACKENDS if b != "remote"], default=None,
+                        help="Model backend (default: OCR_BACKEND or torch)")
+    parser.add_argument("--profiles", nargs="*", choices=sorted(PROFILES), help="Profiles to preload")
+    parser.add_argument("--window-ms", type=float, default=BATCH_WINDOW_MS, help="Micro-batching window")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH, help="Max pages/crops per model call")
+    args = parser.parse_args()
+
+    setup_logging()
+    if args.backend is None and os.environ.get("OCR_BACKEND") == "remote":
+        args.backend = "torch"
+    server = InferenceServer(args.socket, args.backend, window_ms=args.window_ms, max_batch=args.max_batch)
+    for name in args.profiles or []:
+        _, settings = get_profile(name)
+        server.predictor(settings["det_arch"], settings["reco_arch"], settings["detect_orientation"])
+        if settings["name_strategy"] != "doctr_only":
+            server.ocr.get_name_reader()
+    log.info("OCR inference server listening on %s (window %.0f ms, max batch %d)",
+             args.socket, args.window_ms, args.max_batch)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Inference server stopped.")
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from tracing import log
+
+
+def header_tokens(page, header_bottom, tol=0.02):
+    """
+    Lower-cased words of the header line: words whose bottom edge lies within
+    tol (relative page height) above header_bottom.
+    """
+    words = [w for b in page.blocks for l in b.lines for w in l.words
+             if header_bottom - tol <= w.geometry[1][1] <= header_bottom + 0.002]
+    return sorted(w.value.lower() for w in words if w.value)
+
+
+def jaccard(a, b):
+    a, b = set(a), set(b)
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+class LayoutTemplateStore:
+    """
+    Caches the table layout of recurring report formats (one per lab).
+    A template is keyed by its header fingerprint (header tokens + anchor
+    positions) and stores everything the row extractor needs, so matching
+    documents skip find_header_row, get_column_ranges and
+    calculate_adaptive_threshold.
+    Persists data to layout_templates.json.
+    """
+    MAX_TEMPLATES = 50
+    MIN_TOKEN_SIMILARITY = 0.8
+    MAX_ANCHOR_SHIFT = 0.03   # Relative page width
+    MIN_QUALITY_RATIO = 0.6   # Invalidate below this fraction of the template's baseline
+    BASELINE_DECAY = 0.8      # Weight of history in the running baseline
+
+    def __init__(self, store_path=None):
+        if store_path is None:
+            self.store_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "layout_templates.json")
+        else:
+            self.store_path = store_path
+        self.lock = threading.Lock()
+        self.templates = self.load_templates() # { template_id: {...} }
+
+    def load_templates(self):
+        if os.path.exists(self.store_path):
+            try:
+                with open(self.store_path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except Exception as e:
+                log.warning("Could not load layout templates: %s", e)
+        return {}
+
+    def save_templates(self):
+        try:
+            os.makedirs(os.path.dirname(self.store_path), exist_ok=True)
+            tmp_path = self.store_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.templates, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, self.store_path)
+        except Exception as e:
+            log.error("Error saving layout templates: %s", e)
+
+    def match(self, pages, anchor_fn):
+        """
+        Returns the template whose header is found at its recorded position, or None.
+        anchor_fn(line_words) -> (score, anchors, text) re-derives anchor positions
+        from the candidate header words (RobustOCR.match_header_line).
+        """
+        with self.lock:
+            candidates = sorted(self.templates.values(), key=lambda t: -t["hits"])
+        for t in candidates:
+            if t["header_page"] >= len(pages):
+                continue
+            page = pages[t["header_page"]]
+            if jaccard(header_tokens(page, t["header_bottom"]), t["tokens"]) < self.MIN_TOKEN_SIMILARITY:
+                continue
+
+            words = [w for b in page.blocks for l in b.lines for w in l.words
+                     if t["header_bottom"] - 0.02 <= w.geometry[1][1] <= t["header_bottom"] + 0.002]
+            _, anchors, _ = anchor_fn(words)
+            if set(anchors) != set(t["anchors"]):
+                continue
+            if any(abs(anchors[k] - t["anchors"][k]) > self.MAX_ANCHOR_SHIFT for k in anchors):
+                continue
+            return t
+        return None
+
+    def learn(self, pages, layout, quality):
+        """
+        Stores the layout of a document whose header was found by full analysis.
+        """
+        tokens = header_tokens(pages[layout["start_page"]], layout["header_bottom"])
+        if not tokens or not quality["kept"]:
+            return None
+        key = hashlib.sha1(" ".join(tokens).encode("utf-8")).hexdigest()[:12]
+        key = f"{key}_p{layout['start_page']}_{int(layout['header_bottom'] * 100)}"
+        template = {
+            "id": key,
+            "tokens": tokens,
+            "header_page": layout["start_page"],
+            "header_bottom": layout["header_bottom"],
+            "anchors": layout["anchors"],
+            "col_ranges": {k: list(v) for k, v in layout["col_ranges"].items()},
+            "row_threshold": layout["row_threshold"],
+            "footer_cues": layout.get("footer_cues", []),
+            "baseline": quality["score"],
+            "hits": 0,
+            "created": time.time(),
+            "last_used": time.time()
+        }
+        with self.lock:
+            self.templates[key] = template
+            if len(self.templates) > self.MAX_TEMPLATES:
+                oldest = min(self.templates.values(), key=lambda t: t["last_used"])
+                del self.templates[oldest["id"]]
+            self.save_templates()
+        log.info("Learned layout template %s", key)
+        return template
+
+    def record(self, template, quality):
+        """
+        Updates a template after use. Returns False (and drops the template)
+        when the document's extraction quality fell well below its baseline.
+        """
+        with self.lock:
+            if template["id"] not in self.templates:
+                return False
+            if not quality["kept"] or quality["score"] < self.MIN_QUALITY_RATIO * template["baseline"]:
+                del self.templates[template["id"]]
+                self.save_templates()
+                log.warning("Layout template %s invalidated (quality %.2f vs baseline %.2f)",
+                            template["id"], quality["score"], template["baseline"])
+                return False
+            template["hits"] += 1
+            template["last_used"] = time.time()
+            template["baseline"] = (self.BASELINE_DECAY * template["baseline"]
+                                    + (1 - self.BASELINE_DECAY) * quality["score"])
+            for cue in quality.get("footer_cues", []):
+                if cue not in template["footer_cues"]:
+                    template["footer_cues"] = (template["footer_cues"] + [cue])[-5:]
+            # Hits are bookkeeping only; persisted with the next learn/invalidate
+            return True
+
+    @staticmethod
+    def layout_of(template):
+        return {
+            "start_page": template["header_page"],
+            "header_bottom": template["header_bottom"],
+            "anchors": template["anchors"],
+            "col_ranges": {k: tuple(v) for k, v in template["col_ranges"].items()},
+            "row_threshold": template["row_threshold"],
+            "footer_cues": template["footer_cues"]
+        }
@@ -0,0 +1,105 @@
+import time
+import threading
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Metrics:
+    """
+    In-process stage timers and counters.
+    Rendered in the Prometheus text format by api.py's /metrics endpoint.
+    """
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, window=2048):
+        self.window = window
+        self.lock = threading.Lock()
+        # { stage: deque([seconds, ...]) } - recent samples for quantiles
+        self.samples = defaultdict(lambda: deque(maxlen=self.window))
+        # { stage: [count, total_seconds] } - lifetime totals
+        self.totals = defaultdict(lambda: [0, 0.0])
+        # { (name, (("label", "value"), ...)): count }
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the wrapped block and records it under `name`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.samples[name].append(seconds)
+            total = self.totals[name]
+            total[0] += 1
+            total[1] += seconds
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += amount
+
+    def snapshot(self):
+        """
+        Returns { "stages": {...}, "counters": {...} } for JSON consumers.
+        """
+        with self.lock:
+            samples = {k: list(v) for k, v in self.samples.items()}
+            totals = {k: tuple(v) for k, v in self.totals.items()}
+            counters = dict(self.counters)
+
+        stages = {}
+        for name, values in samples.items():
+            arr = np.asarray(values)
+            qs = np.quantile(arr, self.QUANTILES) if len(arr) else [0.0] * len(self.QUANTILES)
+            stages[name] = {
+                "count": totals[name][0],
+                "sum": totals[name][1],
+                "quantiles": dict(zip(self.QUANTILES, (float(q) for q in qs)))
+            }
+        return {"stages": stages, "counters": counters}
+
+    def render_prometheus(self):
+        snap = self.snapshot()
+        lines = []
+
+        if snap["stages"]:
+            lines.append("# HELP ocr_stage_seconds Time spent in each pipeline stage.")
+            lines.append("# TYPE ocr_stage_seconds summary")
+            for name, s in sorted(snap["stages"].items()):
+                for q, v in s["quantiles"].items():
+                    lines.append(f'ocr_stage_seconds{{stage="{name}",quantile="{q}"}} {v:.6f}')
+                lines.append(f'ocr_stage_seconds_sum{{stage="{name}"}} {s["sum"]:.6f}')
+                lines.append(f'ocr_stage_seconds_count{{stage="{name}"}} {s["count"]}')
+
+        seen = set()
+        for (name, labels), value in sorted(snap["counters"].items()):
+            metric = f"ocr_{name}_total"
+            if metric not in seen:
+                lines.append(f"# TYPE {metric} counter")
+                seen.add(metric)
+            label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+            lines.append(f"{metric}{{{label_str}}} {value}" if label_str else f"{metric} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.totals.clear()
+            self.counters.clear()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# Process-wide registry shared by OCR_robust and api.py
+METRICS = Metrics()
@@ -0,0 +1,158 @@
+import os
+import re
+import time
+import hashlib
+
+from sync_manifest import write_json_atomic
+from tracing import log
+
+# Per-patient JSON export for the Flutter client.
+# Each patient is written to patients/<id>.json; patients/index.json lists
+# every shard with its content hash so the app only downloads shards whose
+# hash changed. Shards are rewritten only when their bytes change.
+
+try:
+    import orjson
+
+    def dumps(data):
+        return orjson.dumps(data)
+except ImportError:
+    import json
+
+    def dumps(data):
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+INDEX_NAME = "index.json"
+SAFE_NAME_RE = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def shard_name(patient_id):
+    return SAFE_NAME_RE.sub("_", str(patient_id)) + ".json"
+
+
+def write_bytes_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def result_entry(res):
+    return {
+        "testName": res["Test_Name_OCR"],
+        "testCode": res["Test_Code"],
+        "value": res["Value"],
+        "unit": res["Unit"],
+        "referenceRange": res["Reference_Range"],
+        "flag": res["Flag"],
+        "type": res["Value_Type"],
+        "reliability": res["Reliability_Level"],
+        "page": res["Source_Page"]
+    }
+
+
+def group_patients(master_results, patient_registry):
+    """
+    Patient -> results hierarchy in registry order (camelCase keys for the
+    Dart models). Source files are deduplicated through dict keys.
+    """
+    patients = {}
+    for p in patient_registry:
+        pid = p["Patient_ID"]
+        if pid not in patients:
+            patients[pid] = {
+                "id": pid,
+                "name": p["Patient_Name_Normalized"],
+                "sourceFiles": {},
+                "results": []
+            }
+        patients[pid]["sourceFiles"][p["Source_File"]] = None
+
+    for res in master_results:
+        patient = patients.get(res["Patient_ID"])
+        if patient is not None:
+            patient["results"].append(result_entry(res))
+
+    for patient in patients.values():
+        patient["sourceFiles"] = list(patient["sourceFiles"])
+    return patients
+
+
+def load_index(index_path):
+    import json
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("patients", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def export_shards(master_results, patient_registry, out_dir, combined_path=None):
+    """
+    Writes one shard per patient under out_dir plus out_dir/index.json.
+    A shard is only rewritten when its SHA-256 differs from the previous
+    index (or the file is missing); shards of patients no longer present are
+    removed. With combined_path the old single-file layout is also written,
+    spliced from the shard bytes instead of re-encoding everything.
+    Returns (written, unchanged, removed) shard counts.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    index_path = os.path.join(out_dir, INDEX_NAME)
+    previous = load_index(index_path)
+    exported_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    patients = group_patients(master_results, patient_registry)
+    index = {}
+    shards = []
+    written = unchanged = 0
+    for pid, patient in patients.items():
+        data = dumps(patient)
+        digest = hashlib.sha256(data).hexdigest()
+        name = shard_name(pid)
+        path = os.path.join(out_dir, name)
+        old = previous.get(str(pid))
+        if old and old.get("sha256") == digest and os.path.exists(path):
+            updated_at = old.get("updatedAt", exported_at)
+            unchanged += 1
+        else:
+            write_bytes_atomic(path, data)
+            updated_at = exported_at
+            written += 1
+        index[str(pid)] = {
+            "name": patient["name"],
+            "file": name,
+            "sha256": digest,
+            "bytes": len(data),
+            "tests": len(patient["results"]),
+            "updatedAt": updated_at
+        }
+        if combined_path:
+            shards.append(data)
+
+    removed = 0
+    for pid, old in previous.items():
+        if pid not in index and old.get("file"):
+            try:
+                os.remove(os.path.join(out_dir, old["file"]))
+                removed += 1
+            except OSError:
+                pass
+
+    write_json_atomic(index_path, {
+        "metadata": {
+            "exportDate": exported_at,
+            "totalPatients": len(index),
+            "totalTests": len(master_results)
+        },
+        "patients": index
+    })
+
+    if combined_path:
+        header = dumps({"exportDate": exported_at, "totalPatients": len(index), "totalTests": len(master_results)})
+        write_bytes_atomic(combined_path, b'{"metadata":' + header + b',"patients":[' + b",".join(shards) + b"]}")
+
+    log.info("Patient shards: %d written, %d unchanged, %d removed (%s)", written, unchanged, removed, out_dir)
+    return written, unchanged, removed
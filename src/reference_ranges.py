@@ -0,0 +1,209 @@
+import re
+import math
+from functools import lru_cache
+
+import numpy as np
+
+# Reference-range parsing and abnormal flags.
+# Range strings repeat across thousands of rows, so parsing is memoized per
+# distinct string and flags are computed column-wise over a DataFrame.
+
+NUMBER = r"\d+(?:\.\d+)?"
+NUMBER_RE = re.compile(NUMBER)
+THOUSANDS_RE = re.compile(r"(?<=\d),(?=\d{3}\b)")
+INTERVAL_RE = re.compile(rf"({NUMBER})\s*(?:-|–|—|to)\s*({NUMBER})", re.IGNORECASE)
+UPPER_RE = re.compile(rf"(?:<=?|≤|up\s*to|less\s*than|below)\s*({NUMBER})", re.IGNORECASE)
+LOWER_RE = re.compile(rf"(?:>=?|≥|more\s*than|greater\s*than|above)\s*({NUMBER})", re.IGNORECASE)
+SEX_RE = re.compile(r"\b(males?|men|m|females?|women|f)\b\s*[:\-]?", re.IGNORECASE)
+
+NEGATIVE_TERMS = ("negative", "non-reactive", "non reactive", "nonreactive", "not detected", "absent", "nil")
+POSITIVE_TERMS = ("positive", "reactive", "detected", "present")
+
+FLAG_UNKNOWN = "Unknown"
+
+
+def qualitative(text):
+    """
+    "neg" / "pos" for qualitative results and ranges, None otherwise.
+    Negative terms are checked first ("non-reactive" contains "reactive").
+    """
+    lower = text.lower()
+    if any(t in lower for t in NEGATIVE_TERMS):
+        return "neg"
+    if any(t in lower for t in POSITIVE_TERMS):
+        return "pos"
+    return None
+
+
+def parse_bounds(text):
+    """
+    (low, high) from one range expression; NaN marks an open side.
+    """
+    m = INTERVAL_RE.search(text)
+    if m:
+        return float(m.group(1)), float(m.group(2))
+    m = UPPER_RE.search(text)
+    if m:
+        return math.nan, float(m.group(1))
+    m = LOWER_RE.search(text)
+    if m:
+        return float(m.group(1)), math.nan
+    return None
+
+
+class ReferenceRange:
+    """
+    Parsed reference range.
+    kind: "numeric" (low/high, either side may be NaN), "qualitative"
+    (expected "neg"/"pos") or "unknown". by_sex holds separate bounds for
+    "M"/"F" when the range is sex-specific; low/high is then their envelope.
+    """
+    __slots__ = ("text", "kind", "low", "high", "expected", "by_sex")
+
+    def __init__(self, text, kind="unknown", low=math.nan, high=math.nan, expected=None, by_sex=None):
+        self.text = text
+        self.kind = kind
+        self.low = low
+        self.high = high
+        self.expected = expected
+        self.by_sex = by_sex or {}
+
+    def bounds(self, sex=None):
+        if sex in self.by_sex:
+            return self.by_sex[sex]
+        return self.low, self.high
+
+    def __repr__(self):
+        return f"ReferenceRange({self.text!r}, {self.kind}, {self.low}, {self.high}, {self.expected}, {self.by_sex})"
+
+
+@lru_cache(maxsize=4096)
+def parse_range(text):
+    """
+    Parses "X - Y", "< X", "> X", "M: X - Y F: X - Y" and qualitative
+    ranges ("Negative", "Non-reactive", ...). Memoized by string.
+    """
+    text = THOUSANDS_RE.sub("", (text or "").strip())
+    if not text:
+        return ReferenceRange(text)
+
+    # Sex-specific: split at each sex marker and parse the segment after it
+    markers = list(SEX_RE.finditer(text))
+    if markers:
+        by_sex = {}
+        for i, m in enumerate(markers):
+            end = markers[i + 1].start() if i + 1 < len(markers) else len(text)
+            bounds = parse_bounds(text[m.end():end])
+            if bounds:
+                by_sex.setdefault("F" if m.group(1).lower()[0] in "fw" else "M", bounds)
+        if by_sex:
+            lows = [b[0] for b in by_sex.values()]
+            highs = [b[1] for b in by_sex.values()]
+            low = math.nan if any(math.isnan(v) for v in lows) else min(lows)
+            high = math.nan if any(math.isnan(v) for v in highs) else max(highs)
+            return ReferenceRange(text, "numeric", low, high, by_sex=by_sex)
+
+    bounds = parse_bounds(text)
+    if bounds:
+        return ReferenceRange(text, "numeric", *bounds)
+
+    expected = qualitative(text)
+    if expected:
+        return ReferenceRange(text, "qualitative", expected=expected)
+    return ReferenceRange(text)
+
+
+def parse_value(value):
+    """
+    First number in an OCR'd value ("1,250", "< 0.5 H" ...), or None.
+    """
+    m = NUMBER_RE.search(THOUSANDS_RE.sub("", value))
+    return float(m.group()) if m else None
+
+
+def flag_value(value, ref_range, sex=None):
+    """
+    Flag for a single result: Low / High / Normal, Abnormal for a qualitative
+    result that contradicts a qualitative range, POSITIVE / NEGATIVE for a
+    qualitative result without one, Unknown when value or range is missing.
+    """
+    if not value or not ref_range:
+        return FLAG_UNKNOWN
+    rng = parse_range(ref_range)
+    qual = qualitative(value)
+    if qual:
+        if rng.kind == "qualitative":
+            return "Normal" if qual == rng.expected else "Abnormal"
+        return "NEGATIVE" if qual == "neg" else "POSITIVE"
+
+    num = parse_value(value)
+    if num is not None and rng.kind == "numeric":
+        low, high = rng.bounds(sex)
+        if num < low:
+            return "Low"
+        if num > high:
+            return "High"
+    return "Normal"
+
+
+def compute_flags(df, value_col="Value", range_col="Reference_Range", sex=None):
+    """
+    Vectorized flag_value over a results DataFrame; returns an array of flags.
+    Each distinct range string is parsed once. sex ("M"/"F") applies to the
+    whole frame; without it sex-specific ranges use their envelope.
+    """
+    import pandas as pd
+
+    values = df[value_col].fillna("").astype(str)
+    ranges = df[range_col].fillna("").astype(str)
+
+    codes, uniques = pd.factorize(ranges)
+    parsed = [parse_range(r) for r in uniques]
+    bounds = np.array([p.bounds(sex) for p in parsed] or np.empty((0, 2)), dtype=float).reshape(-1, 2)
+    low, high = bounds[codes, 0], bounds[codes, 1]
+    kind = np.array([p.kind for p in parsed], dtype=object)[codes]
+    expected = np.array([p.expected for p in parsed], dtype=object)[codes]
+
+    lower = values.str.lower()
+    is_neg = lower.str.contains("|".join(NEGATIVE_TERMS), regex=True).to_numpy()
+    is_pos = ~is_neg & lower.str.contains("|".join(POSITIVE_TERMS), regex=True).to_numpy()
+    qual = np.where(is_neg, "neg", np.where(is_pos, "pos", None))
+    is_qual = is_neg | is_pos
+
+    nums = pd.to_numeric(
+        values.str.replace(THOUSANDS_RE.pattern, "", regex=True).str.extract(f"({NUMBER})", expand=False),
+        errors="coerce"
+    ).to_numpy(dtype=float)
+    numeric = ~is_qual & (kind == "numeric") & ~np.isnan(nums)
+
+    missing = (values.str.strip() == "").to_numpy() | (ranges.str.strip() == "").to_numpy()
+    range_qual = is_qual & (kind == "qualitative")
+    with np.errstate(invalid="ignore"):
+        conditions = [
+            missing,
+            range_qual & (qual == expected),
+            range_qual,
+            is_neg,
+            is_pos,
+            numeric & (nums < low),
+            numeric & (nums > high),
+        ]
+    choices = [FLAG_UNKNOWN, "Normal", "Abnormal", "NEGATIVE", "POSITIVE", "Low", "High"]
+    return np.select(conditions, choices, default="Normal")
+
+
+def add_flags(results, sex=None):
+    """
+    Sets "Flag" on every result row in place (one vectorized pass).
+    """
+    if not results:
+        return results
+    import pandas as pd
+    # Column-wise, so ResultRecords and plain dicts both work without a dict per row
+    df = pd.DataFrame({
+        "Value": [r.get("Value") for r in results],
+        "Reference_Range": [r.get("Reference_Range") for r in results]
+    })
+    for r, flag in zip(results, compute_flags(df, sex=sex)):
+        r["Flag"] = str(flag)
+    return results
@@ -0,0 +1,81 @@
+# Compact per-row result record.
+# A backfill keeps every extracted row in memory until export, and an 11-key
+# dict per row costs several times the strings it holds. ResultRecord stores
+# the same fields in __slots__ and still answers record["Value"] /
+# record.get("Flag") so the Excel, JSON, Firestore and Parquet writers read
+# it unchanged.
+
+RESULT_FIELDS = (
+    "Patient_ID", "Patient_Name_Normalized", "Test_Code", "Test_Name_OCR",
+    "Value", "Unit", "Reference_Range", "Flag", "Value_Type", "Row_Type",
+    "Reliability_Level", "Source_Page"
+)
+
+
+class ResultRecord:
+    """
+    One extracted result row. Fields are the RESULT_FIELDS column names;
+    missing ones default to None. Supports item access and get() for code
+    written against the old dict rows, and to_dict() for JSON checkpoints.
+    """
+    __slots__ = RESULT_FIELDS
+
+    def __init__(self, Patient_ID=None, Patient_Name_Normalized=None, Test_Code=None, Test_Name_OCR=None,
+                 Value=None, Unit=None, Reference_Range=None, Flag=None, Value_Type=None, Row_Type=None,
+                 Reliability_Level=None, Source_Page=None):
+        self.Patient_ID = Patient_ID
+        self.Patient_Name_Normalized = Patient_Name_Normalized
+        self.Test_Code = Test_Code
+        self.Test_Name_OCR = Test_Name_OCR
+        self.Value = Value
+        self.Unit = Unit
+        self.Reference_Range = Reference_Range
+        self.Flag = Flag
+        self.Value_Type = Value_Type
+        self.Row_Type = Row_Type
+        self.Reliability_Level = Reliability_Level
+        self.Source_Page = Source_Page
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{k: data.get(k) for k in RESULT_FIELDS})
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in RESULT_FIELDS}
+
+    def keys(self):
+        return RESULT_FIELDS
+
+    def __getitem__(self, key):
+        if key not in RESULT_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in RESULT_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        if key not in RESULT_FIELDS:
+            return default
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f"ResultRecord({self.Test_Code!r}, {self.Value!r}, {self.Unit!r}, {self.Source_Page!r})"
+
+
+def as_records(rows):
+    """
+    ResultRecords from rows that may still be dicts (older checkpoints).
+    """
+    return [r if isinstance(r, ResultRecord) else ResultRecord.from_dict(r) for r in rows]
+
+
+def records_to_frame(records, columns=RESULT_FIELDS):
+    """
+    DataFrame built column by column from the records, without an
+    intermediate dict per row.
+    """
+    import pandas as pd
+    return pd.DataFrame({c: [getattr(r, c) for r in records] for c in columns}, columns=list(columns))
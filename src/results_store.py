@@ -0,0 +1,277 @@
+import os
+import glob
+import shutil
+import zlib
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError: # Windows: no cross-process index lock (single-process dev server)
+    fcntl = None
+
+from tracing import log
+from sync_manifest import write_json_atomic
+
+# Columnar system of record for extracted results.
+# Layout: <root>/patient_bucket=<n>/date=<YYYY-MM-DD>/<doc_id>-<i>.parquet
+# Excel/JSON exports are rebuilt from here as downstream views.
+
+# Columns taken from each result row; the rest are set per document by append()
+RECORD_COLUMNS = (
+    "Patient_ID", "Patient_Name_Normalized", "Test_Code", "Test_Name_OCR",
+    "Value", "Unit", "Reference_Range", "Flag", "Value_Type", "Reliability_Level",
+    "Source_Page"
+)
+RESULT_COLUMNS = [*RECORD_COLUMNS, "Source_File", "Report_ID", "Processed_At"]
+N_BUCKETS = 64
+
+
+def patient_bucket(patient_id, n_buckets=N_BUCKETS):
+    """
+    Stable bucket for a patient ID (numeric IDs use modulo, others CRC32).
+    """
+    pid = str(patient_id)
+    if pid.isdigit():
+        return int(pid) % n_buckets
+    return zlib.crc32(pid.encode("utf-8")) % n_buckets
+
+
+class ResultsStore:
+    """
+    Append-only Parquet dataset of result rows, hive-partitioned by patient-ID
+    bucket and processing date. Each document is written as its own file(s)
+    named by doc_id, so re-processing a document replaces its rows.
+    Reads push patient/test/date predicates down to partitions and row groups.
+    _reports_index.json maps each Report_ID to its patient and document, so a
+    report lookup reads a single bucket. Several API workers share the index:
+    writes reload and merge it under a file lock, lookups reload it when the
+    file changed.
+    """
+    def __init__(self, root=None):
+        if root is None:
+            base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            root = os.path.join(base_dir, "output", "results_parquet")
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(self.root, "_reports_index.json")
+        self.index_mtime = None
+        self.reports = self.load_index() # { report_id: {...} }
+
+    def index_stamp(self):
+        try:
+            return os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load_index(self):
+        # Stamp taken before reading: a write that lands in between triggers another reload
+        self.index_mtime = self.index_stamp()
+        if self.index_mtime is not None:
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except Exception as e:
+                log.warning("Could not load reports index: %s", e)
+        return {}
+
+    @contextmanager
+    def index_lock(self):
+        """
+        Serializes index read-modify-write across threads and processes.
+        """
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.index_path + ".lock", "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def update_index(self, change):
+        """
+        Applies change(reports) to the index as currently on disk (other
+        workers may have written since it was loaded) and writes it back.
+        """
+        with self.index_lock():
+            reports = self.load_index()
+            if change(reports):
+                write_json_atomic(self.index_path, reports)
+                self.index_mtime = self.index_stamp()
+            self.reports = reports
+
+    def report_entry(self, report_id):
+        """
+        Index entry of a report, or None. Picks up reports stored by other workers.
+        """
+        if self.index_stamp() != self.index_mtime:
+            self.reports = self.load_index()
+        return self.reports.get(report_id)
+
+    @staticmethod
+    def _pa():
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        return pa, ds
+
+    def schema(self):
+        pa, _ = self._pa()
+        fields = [(c, pa.string()) for c in RESULT_COLUMNS if c != "Processed_At"]
+        fields.append(("Processed_At", pa.timestamp("us", tz="UTC")))
+        return pa.schema(fields)
+
+    def partitioning(self):
+        pa, ds = self._pa()
+        return ds.partitioning(pa.schema([("patient_bucket", pa.int32()), ("date", pa.string())]), flavor="hive")
+
+    def remove(self, doc_id):
+        """
+        Deletes a document's files from every partition.
+        """
+        for path in glob.glob(os.path.join(self.root, "*", "*", f"{doc_id}-*.parquet")):
+            os.remove(path)
+
+        def drop(reports):
+            stale = [k for k, e in reports.items() if e["doc_id"] == doc_id]
+            for k in stale:
+                del reports[k]
+            return stale
+        self.update_index(drop)
+
+    def append(self, results, doc_id, source_file, report_id=None, processed_at=None, replaces=None):
+        """
+        Writes one document's result rows. Any earlier version of the document
+        (same doc_id, or replaces=<previous doc_id>) is removed first.
+        """
+        pa, ds = self._pa()
+        for old_id in {doc_id, replaces} - {None}:
+            self.remove(old_id)
+        if not results:
+            return 0
+
+        processed_at = processed_at or datetime.now(timezone.utc)
+        columns = {c: [] for c in RESULT_COLUMNS}
+        for r in results:
+            for c in RECORD_COLUMNS:
+                v = r.get(c)
+                columns[c].append(None if v is None else str(v))
+        n = len(results)
+        columns["Source_File"] = [source_file] * n
+        columns["Report_ID"] = [report_id] * n
+        columns["Processed_At"] = [processed_at] * n
+
+        table = pa.table(columns, schema=self.schema())
+        table = table.append_column("patient_bucket", pa.array([patient_bucket(p) for p in columns["Patient_ID"]], pa.int32()))
+        table = table.append_column("date", pa.array([processed_at.strftime("%Y-%m-%d")] * n, pa.string()))
+
+        # Written to a hidden staging dir (ignored by dataset discovery) and then
+        # renamed into place, so concurrent readers never see a partial file
+        staging = os.path.join(self.root, ".staging", f"{doc_id}-{threading.get_ident()}")
+        ds.write_dataset(
+            table, staging, format="parquet",
+            partitioning=self.partitioning(),
+            basename_template=f"{doc_id}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore"
+        )
+        for path in glob.glob(os.path.join(staging, "*", "*", "*.parquet")):
+            target = os.path.join(self.root, os.path.relpath(path, staging))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+        shutil.rmtree(staging, ignore_errors=True)
+        if report_id:
+            entry = {
+                "doc_id": doc_id,
+                "patient_id": columns["Patient_ID"][0],
+                "source_file": source_file,
+                "processed_at": processed_at.isoformat(),
+                "rows": n
+            }
+
+            def add(reports):
+                reports[report_id] = entry
+                return True
+            self.update_index(add)
+        return n
+
+    def read(self, patient_id=None, test_code=None, since=None, columns=None, report_id=None, until=None):
+        """
+        Returns a DataFrame of matching rows. patient_id prunes to one bucket
+        directory; since (YYYY-MM-DD) and until (a UTC datetime, inclusive
+        upper bound on Processed_At) prune date directories.
+        """
+        pa, ds = self._pa()
+        dataset = ds.dataset(self.root, format="parquet", schema=self._dataset_schema(), partitioning=self.partitioning())
+        expr = None
+
+        def both(a, b):
+            return b if a is None else a & b
+
+        if patient_id is not None:
+            expr = both(expr, (ds.field("patient_bucket") == patient_bucket(patient_id)) & (ds.field("Patient_ID") == str(patient_id)))
+        if test_code is not None:
+            expr = both(expr, ds.field("Test_Code") == test_code)
+        if since is not None:
+            expr = both(expr, ds.field("date") >= since)
+        if report_id is not None:
+            expr = both(expr, ds.field("Report_ID") == report_id)
+        if until is not None:
+            until = until.astimezone(timezone.utc)
+            expr = both(expr, (ds.field("date") <= until.strftime("%Y-%m-%d")) & (ds.field("Processed_At") <= pa.scalar(until, pa.timestamp("us", tz="UTC"))))
+        return dataset.to_table(filter=expr, columns=columns).to_pandas()
+
+    def read_report(self, report_id, columns=None):
+        """
+        Returns (index entry, DataFrame) for a report, or (None, None) if unknown.
+        """
+        entry = self.report_entry(report_id)
+        if entry is None:
+            return None, None
+        return entry, self.read(patient_id=entry["patient_id"], report_id=report_id, columns=columns)
+
+    def version(self, patient_id=None):
+        """
+        Cheap change token for ETags: hashes the names, sizes and mtimes of the
+        files a read would touch (one bucket when patient_id is given), without
+        opening them.
+        """
+        if patient_id is None:
+            pattern = os.path.join(self.root, "*", "*", "*.parquet")
+        else:
+            pattern = os.path.join(self.root, f"patient_bucket={patient_bucket(patient_id)}", "*", "*.parquet")
+        h = hashlib.sha1(str(patient_id).encode("utf-8"))
+        for path in sorted(glob.glob(pattern)):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            h.update(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns};".encode("utf-8"))
+        return h.hexdigest()[:20]
+
+    def _dataset_schema(self):
+        pa, _ = self._pa()
+        schema = self.schema()
+        return schema.append(pa.field("patient_bucket", pa.int32())).append(pa.field("date", pa.string()))
+
+    def export_excel(self, output_path):
+        """
+        Rebuilds the Excel view (All_Results sheet) from the dataset.
+        """
+        import pandas as pd
+        # Concurrent uploads each rebuild the view: snapshot and write under the
+        # lock so an older snapshot never replaces a newer one
+        tmp_path = f"{output_path}.{threading.get_ident()}.tmp.xlsx"
+        with self.lock:
+            df = self.read(columns=RESULT_COLUMNS)
+            df["Processed_At"] = df["Processed_At"].dt.tz_localize(None)
+            with pd.ExcelWriter(tmp_path, engine='openpyxl') as writer:
+                df.to_excel(writer, sheet_name="All_Results", index=False)
+            os.replace(tmp_path, output_path)
+        log.info("Excel view rebuilt at %s (%d rows)", output_path, len(df))
+        return output_path
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from tracing import log
+from result_records import as_records
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_json_atomic(path, data, **kwargs):
+    """
+    Writes JSON to a temp file and renames it over path, so a crash never
+    leaves a half-written file behind.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SyncManifest:
+    """
+    Tracks processed input files (path, size, mtime, content hash, pipeline
+    version) so batch runs only process new or changed files.
+    Each document's results are checkpointed to results_dir/<hash>.json as soon
+    as it is processed, so an interrupted run resumes where it stopped.
+    Persists data to processed_manifest.json.
+    """
+    def __init__(self, manifest_path, results_dir, pipeline_version):
+        self.manifest_path = manifest_path
+        self.results_dir = results_dir
+        self.pipeline_version = pipeline_version
+        self.lock = threading.Lock()
+        os.makedirs(self.results_dir, exist_ok=True)
+        self.entries = self.load_manifest() # { key: {...} }
+
+    def load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    return json.load(f).get("files", {})
+            except Exception as e:
+                log.warning("Could not load manifest, starting fresh: %s", e)
+        return {}
+
+    def save_manifest(self):
+        write_json_atomic(self.manifest_path, {"files": self.entries}, indent=1)
+
+    def needs_processing(self, key, path, settle_seconds=0):
+        """
+        Returns (True, sha256) if the file is new, changed or was processed by
+        another pipeline version; (False, None) otherwise.
+        A file that failed is not retried until its content or the pipeline
+        version changes (or the caller forces it, e.g. --full), so a corrupt
+        file is not re-OCR'd on every pass.
+        Files modified in the last settle_seconds are skipped (still being written).
+        """
+        st = os.stat(path)
+        if settle_seconds and time.time() - st.st_mtime < settle_seconds:
+            return False, None
+
+        entry = self.entries.get(key)
+        if (entry and entry["status"] in ("done", "failed")
+                and entry["pipeline_version"] == self.pipeline_version
+                and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime):
+            return False, None # Fast path: no hashing
+
+        sha = file_sha256(path)
+        if (entry and entry["status"] in ("done", "failed")
+                and entry["pipeline_version"] == self.pipeline_version and entry["sha256"] == sha):
+            # Touched but unchanged: refresh stat info only
+            with self.lock:
+                entry["size"], entry["mtime"] = st.st_size, st.st_mtime
+                self.save_manifest()
+            return False, None
+        return True, sha
+
+    def record(self, key, path, sha, results, patient_info):
+        """
+        Checkpoints one processed document: results file first, then the manifest.
+        """
+        results_file = f"{sha}.json"
+        write_json_atomic(os.path.join(self.results_dir, results_file), {
+            "source_file": key,
+            "patient_id": patient_info[0] if patient_info else "UNKNOWN",
+            "patient_name": patient_info[1] if patient_info else "UNKNOWN",
+            "results": [dict(r) for r in results]
+        }, default=str)
+        st = os.stat(path)
+        with self.lock:
+            self.entries[key] = {
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "sha256": sha,
+                "pipeline_version": self.pipeline_version,
+                "status": "done",
+                "results_file": results_file,
+                "processed_at": time.time()
+            }
+            self.save_manifest()
+
+    def record_failure(self, key, path, sha, error):
+        st = os.stat(path)
+        with self.lock:
+            self.entries[key] = {
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "sha256": sha,
+                "pipeline_version": self.pipeline_version,
+                "status": "failed",
+                "error": str(error),
+                "processed_at": time.time()
+            }
+            self.save_manifest()
+
+    def collect(self):
+        """
+        Loads every checkpointed document.
+        Returns (master_results, patient_registry) in the shape export_master expects.
+        """
+        master_results, patient_registry = [], []
+        with self.lock:
+            done = sorted((k, e) for k, e in self.entries.items() if e["status"] == "done")
+        for key, entry in done:
+            try:
+                with open(os.path.join(self.results_dir, entry["results_file"]), "r", encoding="utf-8") as f:
+                    doc = json.load(f)
+            except Exception as e:
+                log.warning("Missing checkpoint for %s: %s", key, e)
+                continue
+            master_results.extend(as_records(doc["results"]))
+            patient_registry.append({
+                "Patient_ID": doc["patient_id"],
+                "Patient_Name_Normalized": doc["patient_name"],
+                "Source_File": doc["source_file"]
+            })
+        return master_results, patient_registry
+
+
+def watch_directory(path, on_change, interval=5.0, stop_event=None):
+    """
+    Calls on_change() whenever files land in path, and at least every interval
+    seconds. Uses inotify through watchdog when installed, polling otherwise.
+    """
+    stop_event = stop_event or threading.Event()
+    wake = threading.Event()
+    observer = None
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+
+        class _Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if not event.is_directory:
+                    wake.set()
+
+        observer = Observer()
+        observer.schedule(_Handler(), path, recursive=False)
+        observer.start()
+        log.info("Watching %s (inotify)", path)
+    except ImportError:
+        log.info("Watching %s (polling every %.0fs; pip install watchdog for inotify)", path, interval)
+
+    try:
+        while not stop_event.is_set():
+            on_change()
+            wake.wait(interval)
+            wake.clear()
+    except KeyboardInterrupt:
+        log.info("Watch stopped.")
+    finally:
+        if observer:
+            observer.stop()
+            observer.join()
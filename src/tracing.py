@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+
+# ================= LOGGING =================
+# OCR_LOG_LEVEL=DEBUG|INFO|WARNING (default INFO)
+# OCR_TRACE=1                 write per-document trace artifacts
+# OCR_TRACE_SAMPLE=0.1        fraction of documents to trace (default 1.0)
+# OCR_TRACE_DIR=...           trace root (default <BASE_DIR>/logs/traces)
+
+log = logging.getLogger("ocr")
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRACE_DIR = os.environ.get("OCR_TRACE_DIR", os.path.join(BASE_DIR, "logs", "traces"))
+
+
+def setup_logging(level=None):
+    """
+    Configures the "ocr" logger once. Messages use %-style args so they are
+    only formatted when the level is enabled.
+    """
+    level = level or os.environ.get("OCR_LOG_LEVEL", "INFO")
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(message)s"))
+        log.addHandler(handler)
+        log.propagate = False
+    log.setLevel(level.upper() if isinstance(level, str) else level)
+
+
+# ================= PER-DOCUMENT TRACES =================
+
+class NullTrace:
+    """
+    Disabled trace. Every call is a no-op so the hot loops pay nothing.
+    """
+    enabled = False
+    job_dir = None
+
+    def row(self, page, **fields): pass
+    def rejection(self, page, text, reason): pass
+    def anchors(self, page, header_bottom, anchors): pass
+    def text(self, name, content): pass
+    def close(self): pass
+
+
+class DocumentTrace:
+    """
+    Collects rows, rejections and anchors for one document and writes them
+    to <TRACE_DIR>/<job_id>/ on close().
+    """
+    enabled = True
+
+    def __init__(self, job_id, source=None):
+        self.job_dir = os.path.join(TRACE_DIR, job_id)
+        self.source = source
+        self.started = time.time()
+        self.rows = []
+        self.rejections = []
+        self.layout = {}
+        self.texts = {}
+
+    def row(self, page, **fields):
+        self.rows.append({"page": page, **fields})
+
+    def rejection(self, page, text, reason):
+        self.rejections.append({"page": page, "text": text, "reason": reason})
+
+    def anchors(self, page, header_bottom, anchors):
+        self.layout = {"header_page": page, "header_bottom": header_bottom, "anchors": anchors}
+
+    def text(self, name, content):
+        self.texts[name] = content
+
+    def close(self):
+        try:
+            os.makedirs(self.job_dir, exist_ok=True)
+            summary = {
+                "source": self.source,
+                "started": self.started,
+                "duration": round(time.time() - self.started, 3),
+                "rows": len(self.rows),
+                "rejections": len(self.rejections),
+                **self.layout
+            }
+            with open(os.path.join(self.job_dir, "summary.json"), "w", encoding="utf-8") as f:
+                json.dump(summary, f, indent=2, ensure_ascii=False, default=str)
+            self._write_jsonl("rows.jsonl", self.rows)
+            self._write_jsonl("rejections.jsonl", self.rejections)
+            for name, content in self.texts.items():
+                with open(os.path.join(self.job_dir, f"{name}.txt"), "w", encoding="utf-8") as f:
+                    f.write(content)
+            log.debug("Trace written to %s", self.job_dir)
+        except Exception as e:
+            log.warning("Could not write trace to %s: %s", self.job_dir, e)
+
+    def _write_jsonl(self, filename, records):
+        with open(os.path.join(self.job_dir, filename), "w", encoding="utf-8") as f:
+            for rec in records:
+                f.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+
+
+NULL_TRACE = NullTrace()
+_job_counter = 0
+_job_lock = threading.Lock()
+
+
+def start_trace(source=None):
+    """
+    Returns a DocumentTrace if tracing is enabled and this document is sampled,
+    otherwise the shared NullTrace.
+    """
+    if os.environ.get("OCR_TRACE", "0").lower() in ("", "0", "false", "no"):
+        return NULL_TRACE
+    sample = float(os.environ.get("OCR_TRACE_SAMPLE", "1.0"))
+    if sample < 1.0 and random.random() >= sample:
+        return NULL_TRACE
+
+    global _job_counter
+    with _job_lock:
+        _job_counter += 1
+        seq = _job_counter
+    stem = os.path.splitext(os.path.basename(source))[0] if isinstance(source, str) else "batch"
+    job_id = f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{seq}_{stem}"
+    return DocumentTrace(job_id, source)
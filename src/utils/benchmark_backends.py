@@ -0,0 +1,118 @@
+"""
+Compares OCR inference backends (torch docTR vs ONNX Runtime, optionally int8)
+on the PDFs in input/.
+
+Usage:
+    python src/utils/benchmark_backends.py [--runs 3] [--files a.pdf b.pdf]
+
+Latency is the detect_recognize stage (models are warmed up first).
+Accuracy is row agreement against the torch backend: a row matches when
+(Test_Code, Value) is identical on the same page.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from OCR_robust import RobustOCR, INPUT_DIR, OUTPUT_DIR  # noqa: E402
+from metrics import METRICS  # noqa: E402
+
+CONFIGS = [
+    ("torch", False),
+    ("onnx", False),
+    ("onnx", True),
+]
+
+
+def row_keys(results):
+    return {(r["Source_Page"], r["Test_Code"], r["Value"]) for r in results}
+
+
+def agreement(reference, candidate):
+    ref, cand = row_keys(reference), row_keys(candidate)
+    if not ref and not cand:
+        return {"precision": 1.0, "recall": 1.0, "f1": 1.0}
+    tp = len(ref & cand)
+    precision = tp / len(cand) if cand else 0.0
+    recall = tp / len(ref) if ref else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": round(precision, 4), "recall": round(recall, 4), "f1": round(f1, 4)}
+
+
+def run_config(backend, quantized, files, runs):
+    # No layout templates: each config runs the full layout analysis, and the
+    # benchmark must not learn into the real template store
+    ocr = RobustOCR(backend=backend, quantized=quantized, templates=False)
+    ocr.warm_up()
+
+    latencies = []
+    outputs = {}
+    for pdf in files:
+        for _ in range(runs):
+            METRICS.reset()
+            start = time.perf_counter()
+            results, _ = ocr.process_document(pdf)
+            total = time.perf_counter() - start
+            stage = METRICS.snapshot()["stages"].get("detect_recognize", {})
+            latencies.append((stage.get("sum", total), total))
+        outputs[pdf] = results
+    return latencies, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="Runs per file per backend")
+    parser.add_argument("--files", nargs="*", help="PDF names in input/ (default: all)")
+    args = parser.parse_args()
+
+    names = args.files or sorted(f for f in os.listdir(INPUT_DIR) if f.lower().endswith(".pdf"))
+    files = [os.path.join(INPUT_DIR, f) for f in names]
+    if not files:
+        print(f"No PDF files found in {INPUT_DIR}")
+        return
+
+    report = {"files": names, "runs": args.runs, "configs": []}
+    reference = None
+
+    for backend, quantized in CONFIGS:
+        label = f"{backend}{'-int8' if quantized else ''}"
+        print(f"\n=== {label} ===")
+        try:
+            latencies, outputs = run_config(backend, quantized, files, args.runs)
+        except ImportError as e:
+            print(f"Skipping {label}: {e}")
+            continue
+
+        if reference is None:
+            reference = outputs
+        scores = [agreement(reference[f], outputs[f]) for f in files]
+        inference = np.array([l[0] for l in latencies])
+        end_to_end = np.array([l[1] for l in latencies])
+
+        entry = {
+            "config": label,
+            "inference_p50_s": round(float(np.percentile(inference, 50)), 3),
+            "inference_p99_s": round(float(np.percentile(inference, 99)), 3),
+            "end_to_end_p50_s": round(float(np.percentile(end_to_end, 50)), 3),
+            "rows": sum(len(outputs[f]) for f in files),
+            "f1_vs_reference": round(float(np.mean([s["f1"] for s in scores])), 4),
+            "per_file": {os.path.basename(f): s for f, s in zip(files, scores)}
+        }
+        report["configs"].append(entry)
+        print(json.dumps({k: v for k, v in entry.items() if k != "per_file"}, indent=2))
+
+    out_dir = os.path.join(OUTPUT_DIR, "benchmarks")
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, f"backends_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nBenchmark saved to: {out_path}")
+
+
+if __name__ == "__main__":
+    main()
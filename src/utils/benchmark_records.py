@@ -0,0 +1,120 @@
+"""
+Memory benchmark: result rows as dicts (the old per-row shape) vs ResultRecord.
+
+Usage:
+    python src/utils/benchmark_records.py [--rows 100000 1000000]
+
+Builds N synthetic rows the way extract_rows does (fresh OCR strings per row,
+shared patient/page strings), then measures with tracemalloc:
+  - bytes per row held in the list,
+  - peak memory and time of the DataFrame conversion used by the exports,
+  - time of the vectorized flag pass.
+No OCR models are needed.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from OCR_robust import OUTPUT_DIR  # noqa: E402
+from result_records import ResultRecord, records_to_frame  # noqa: E402
+from reference_ranges import add_flags  # noqa: E402
+
+TESTS = ("HEMOGLOBIN", "WBC", "PLATELETS", "GLUCOSE", "CREATININE", "ALT", "AST", "SODIUM")
+EXPORT_COLUMNS = ["Patient_ID", "Patient_Name_Normalized", "Test_Name_OCR", "Value", "Unit", "Reference_Range", "Flag", "Value_Type", "Reliability_Level", "Source_Page"]
+
+
+def row_fields(i):
+    # OCR output is new string objects per row; join() mimics that
+    code = TESTS[i % len(TESTS)]
+    return {
+        "Patient_ID": 1000 + i // 40,
+        "Patient_Name_Normalized": "patient name",
+        "Test_Code": code,
+        "Test_Name_OCR": " ".join([code.title(), "Level"]),
+        "Value": " ".join([str(i % 250), ""]).strip(),
+        "Unit": " ".join(["mg/dL"]),
+        "Reference_Range": " ".join(["10", "-", "200"]),
+        "Value_Type": "PRIMARY",
+        "Row_Type": "DATA",
+        "Reliability_Level": "HIGH",
+        "Source_Page": "Page 1"
+    }
+
+
+def build_dicts(n):
+    return [row_fields(i) for i in range(n)]
+
+
+def build_records(n):
+    return [ResultRecord(**row_fields(i)) for i in range(n)]
+
+
+def measure(label, build, to_frame, n):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = build(n)
+    build_s = time.perf_counter() - start
+    held = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    add_flags(rows)
+    flags_s = time.perf_counter() - start
+
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    df = to_frame(rows)
+    frame_s = time.perf_counter() - start
+    frame_peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    assert len(df) == n
+    del rows, df
+    return {
+        "kind": label,
+        "rows": n,
+        "held_mb": round(held / 1024 ** 2, 2),
+        "bytes_per_row": round(held / n, 1),
+        "build_s": round(build_s, 3),
+        "add_flags_s": round(flags_s, 3),
+        "to_frame_s": round(frame_s, 3),
+        "to_frame_peak_mb": round(frame_peak / 1024 ** 2, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="*", default=[100000, 500000], help="Row counts to measure")
+    args = parser.parse_args()
+
+    import pandas as pd
+
+    def dict_frame(rows):
+        return pd.DataFrame(rows)[EXPORT_COLUMNS]
+
+    def record_frame(rows):
+        return records_to_frame(rows, EXPORT_COLUMNS)
+
+    report = {"runs": []}
+    for n in args.rows:
+        for label, build, to_frame in (("dict", build_dicts, dict_frame), ("ResultRecord", build_records, record_frame)):
+            result = measure(label, build, to_frame, n)
+            report["runs"].append(result)
+            print(json.dumps(result))
+
+    out_dir = os.path.join(OUTPUT_DIR, "benchmarks")
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, f"result_records_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nBenchmark saved to: {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Regression check: content cropping and appendix text must not lose rows.
+
+Usage:
+    python src/utils/check_crop_geometry.py [--profile balanced]
+
+Every page is cropped to its own content box (see preprocess_page), so a
+continuation page without the letterhead is cropped much lower than page 1.
+The header position and column ranges found on page 1 only apply to the
+other pages once everything is in full-page coordinates. Page 1 also ends
+in interpretation text, so later pages are screened for rows before they
+are read, and page 2 has a row with a long reference note.
+
+Renders a 2-page report whose second page has no letterhead and runs it
+through RobustOCR.process_document. No OCR models are needed: each word is
+drawn in its own color, and a stand-in predictor "detects" words by color and
+"recognizes" a crop by its dominant color. Exits 1 when a row is missing.
+"""
+import os
+import sys
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from OCR_robust import (RobustOCR, PROFILES, OCRDocument, OCRPage, OCRBlock, OCRLine, OCRWord,  # noqa: E402
+                        crop_word, get_profile)
+
+PAGE_SIZE = (2339, 1654) # A4 at 200 dpi
+COLUMNS_X = (100, 550, 750, 950)
+PAGE_1_ROWS = (("Hemoglobin", "13.5", "g/dL", "13 - 17"), ("WBC", "7.2", "10^3/uL", "4 - 11"),
+               ("Platelets", "250", "10^3/uL", "150 - 450"), ("Glucose", "95", "mg/dL", "70 - 110"))
+PAGE_2_ROWS = (("Creatinine", "1.1", "mg/dL", "0.7 - 1.3"), ("Sodium", "140", "mmol/L", "135 - 145"),
+               ("Potassium", "4.2", "mmol/L", "3.5 - 5.1"),
+               ("LDL Cholesterol", "120", "mg/dL", "< 100 recommended by NCEP guidelines"))
+
+
+def word_color(i):
+    # Dark, distinct and exact (no anti-aliasing) so it survives the crop
+    return (16 * (i % 8), 16 * (i // 8 % 8), 16 * (i // 64 % 8))
+
+
+class SyntheticReport:
+    """
+    Renders pages and keeps the text of every colored word.
+    """
+    def __init__(self):
+        self.words = {} # { (r, g, b): text }
+        self.pages = []
+
+    def page(self):
+        self.pages.append(np.full(PAGE_SIZE + (3,), 255, np.uint8))
+
+    def text(self, x, y, line):
+        import cv2
+        for word in line.split(" "):
+            color = word_color(len(self.words))
+            self.words[color] = word
+            cv2.putText(self.pages[-1], word, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1.0, color, 2, cv2.LINE_8)
+            x += cv2.getTextSize(word + " ", cv2.FONT_HERSHEY_SIMPLEX, 1.0, 2)[0][0]
+
+    def row(self, y, cells):
+        for x, cell in zip(COLUMNS_X, cells):
+            self.text(x, y, cell)
+
+
+def build_report():
+    report = SyntheticReport()
+    report.page()
+    report.text(100, 150, "Patient Name: JOHN SMITH")
+    report.text(100, 220, "Lab No: 12345")
+    report.row(400, ("Test Name", "Result", "Unit", "Reference Range"))
+    for i, cells in enumerate(PAGE_1_ROWS):
+        report.row(480 + i * 70, cells)
+    report.text(100, 800, "Interpretation:")
+    report.text(100, 870, "Values according to CDC guidelines should be reviewed by the physician")
+    report.text(100, 2200, "Signature")
+
+    # Continuation page: no letterhead, so its crop starts much lower
+    report.page()
+    for i, cells in enumerate(PAGE_2_ROWS):
+        report.row(480 + i * 70, cells)
+    report.text(100, 2200, "Signature")
+    return report
+
+
+class ColorPredictor:
+    """
+    Stand-in for a docTR predictor (full call, det_predictor and
+    reco_predictor) over a SyntheticReport's pages.
+    """
+    def __init__(self, words):
+        self.words = words
+        self.det_predictor = self.detect
+        self.reco_predictor = self.recognize
+
+    def __call__(self, pages):
+        doc_pages = []
+        for img, out in zip(pages, self.detect(pages)):
+            boxes = [((b[0], b[1]), (b[2], b[3])) for b in out["words"]]
+            crops = [crop_word(img, geom) for geom in boxes]
+            blocks = [OCRBlock(geom, [OCRLine(geom, [OCRWord(value, conf, geom)])])
+                      for geom, (value, conf) in zip(boxes, self.recognize(crops))]
+            doc_pages.append(OCRPage(blocks, img.shape[:2]))
+        return OCRDocument(doc_pages)
+
+    def detect(self, pages):
+        out = []
+        for img in pages:
+            h, w = img.shape[:2]
+            boxes = []
+            for color in self.words:
+                ys, xs = np.nonzero(np.all(img == color, axis=2))
+                if len(xs):
+                    boxes.append((xs.min() / w, ys.min() / h, (xs.max() + 1) / w, (ys.max() + 1) / h, 1.0))
+            out.append({"words": np.array(boxes)})
+        return out
+
+    def recognize(self, crops):
+        preds = []
+        for crop in crops:
+            colors, counts = np.unique(crop.reshape(-1, 3), axis=0, return_counts=True)
+            found = [(n, tuple(int(v) for v in c)) for c, n in zip(colors, counts) if tuple(int(v) for v in c) in self.words]
+            preds.append((self.words[max(found)[1]], 0.99) if found else ("", 0.0))
+        return preds
+
+
+def run(profile):
+    import cv2
+    report = build_report()
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i, img in enumerate(report.pages):
+            paths.append(os.path.join(tmp, f"page_{i + 1}.png"))
+            cv2.imwrite(paths[-1], img[:, :, ::-1])
+        # "remote" pages are plain RGB arrays, so docTR itself is not needed
+        ocr = RobustOCR(backend="remote", profile=profile, templates=False)
+        ocr.predictors[profile] = ColorPredictor(report.words)
+        results, _ = ocr.process_document(paths)
+
+    expected = [cells[0] for cells in PAGE_1_ROWS + PAGE_2_ROWS]
+    found = [r["Test_Name_OCR"] for r in results]
+    missing = [t for t in expected if t not in found]
+    print(f"[{profile}] rows: {', '.join(found) or '-'}")
+    if missing:
+        print(f"[{profile}] FAILED, missing rows: {', '.join(missing)}")
+    return not missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", nargs="*", default=[n for n, s in PROFILES.items() if s["preprocess"].get("color") == "color"],
+                        help="Profiles to check (color-preserving ones only)")
+    args = parser.parse_args()
+    ok = all([run(get_profile(p)[0]) for p in args.profile])
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""
+Load test for the Flask API (/upload_report).
+
+Replays a corpus - the PDFs/images in input/ plus synthetic lab reports -
+against /upload_report at a fixed concurrency (closed loop) or a fixed
+arrival rate (open loop, Poisson arrivals). Reports throughput, p50/p95/p99
+latency, error rate per status and peak RSS, and saves a JSON report to
+output/benchmarks/ that --compare can diff against a previous build.
+
+By default the API runs in-process on a free port with its uploads, results,
+patient registry and layout templates redirected to a temp directory, so the
+test never touches real data (the API does not upload to Firebase). Use
+--url to hit a server that is already running (--server-pid samples its RSS).
+
+Usage:
+    python src/utils/loadtest_api.py [--concurrency 4] [--requests 40]
+    python src/utils/loadtest_api.py --rate 2 --duration 60 --profile fast
+    python src/utils/loadtest_api.py --compare output/benchmarks/api_load_A.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlparse
+
+import numpy as np
+
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.dirname(UTILS_DIR)
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, UTILS_DIR)
+
+from OCR_robust import OUTPUT_DIR  # noqa: E402
+from loadtest_inference import synthetic_page  # noqa: E402
+
+CORPUS_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png", ".tif", ".tiff")
+
+
+# ================= CORPUS =================
+
+def build_corpus(input_dir, synthetic):
+    """
+    [(filename, bytes)] from input_dir plus `synthetic` rendered PNG reports.
+    """
+    import cv2
+    corpus = []
+    if input_dir and os.path.isdir(input_dir):
+        for name in sorted(os.listdir(input_dir)):
+            if name.lower().endswith(CORPUS_EXTENSIONS) and not name.startswith("."):
+                with open(os.path.join(input_dir, name), "rb") as f:
+                    corpus.append((name, f.read()))
+    for i in range(synthetic):
+        ok, buf = cv2.imencode(".png", synthetic_page(1000 + i))
+        corpus.append((f"synthetic_{i}.png", buf.tobytes()))
+    return corpus
+
+
+def multipart_body(filename, data, fields):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for k, v in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode("utf-8"))
+    parts.append((f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                  f'Content-Type: application/octet-stream\r\n\r\n').encode("utf-8"))
+    parts.append(data)
+    parts.append(f"\r\n--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+# ================= TARGET =================
+
+def start_in_process_server(work_dir):
+    """
+    Imports api.py with its storage redirected to work_dir and serves it on
+    a free local port. Returns the base URL.
+    """
+    import api
+    from OCR_robust import PatientManager
+    from results_store import ResultsStore
+    from layout_templates import LayoutTemplateStore
+    from werkzeug.serving import make_server
+
+    upload_dir = os.path.join(work_dir, "input")
+    os.makedirs(upload_dir, exist_ok=True)
+    api.UPLOAD_FOLDER = upload_dir
+    api.app.config['UPLOAD_FOLDER'] = upload_dir
+    api.OUTPUT_FOLDER = os.path.join(work_dir, "output")
+    os.makedirs(api.OUTPUT_FOLDER, exist_ok=True)
+    api.results_store = ResultsStore(os.path.join(api.OUTPUT_FOLDER, "results_parquet"))
+    api.patient_manager = PatientManager(os.path.join(work_dir, "patient_registry.json"))
+    if api.ocr.templates is not None:
+        # Start from a copy of the learned layouts; what the run learns stays in work_dir
+        templates_path = os.path.join(work_dir, "layout_templates.json")
+        if os.path.exists(api.ocr.templates.store_path):
+            shutil.copyfile(api.ocr.templates.store_path, templates_path)
+        api.ocr.templates = LayoutTemplateStore(templates_path)
+
+    server = make_server("127.0.0.1", 0, api.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="api-under-test", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+def wait_ready(base_url, timeout):
+    url = urlparse(base_url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(url.hostname, url.port, timeout=5)
+            conn.request("GET", "/ready")
+            status = conn.getresponse().status
+            conn.close()
+            if status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(1)
+    return False
+
+
+class RssSampler:
+    """
+    Samples VmRSS of a pid every interval seconds and keeps the peak.
+    """
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def read(self):
+        try:
+            with open(f"/proc/{self.pid}/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.peak = max(self.peak, self.read())
+            self.stop_event.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.read())
+
+
+# ================= LOAD =================
+
+def upload(base_url, filename, data, fields, timeout):
+    url = urlparse(base_url)
+    body, content_type = multipart_body(filename, data, fields)
+    start = time.perf_counter()
+    try:
+        conn = http.client.HTTPConnection(url.hostname, url.port, timeout=timeout)
+        conn.request("POST", "/upload_report", body=body, headers={"Content-Type": content_type})
+        resp = conn.getresponse()
+        resp.read()
+        status = resp.status
+        conn.close()
+    except Exception as e:
+        status = type(e).__name__
+    return time.perf_counter() - start, status
+
+
+def run_closed_loop(base_url, corpus, fields, concurrency, requests, timeout):
+    samples = []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            name, data = corpus[i % len(corpus)]
+            latency, status = upload(base_url, name, data, fields, timeout)
+            with lock:
+                samples.append((latency, status))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return samples
+
+
+def run_open_loop(base_url, corpus, fields, rate, duration, max_in_flight, timeout, seed):
+    rng = random.Random(seed)
+    samples, threads = [], []
+    lock = threading.Lock()
+    in_flight = threading.Semaphore(max_in_flight)
+    dropped = 0
+
+    def fire(name, data):
+        try:
+            latency, status = upload(base_url, name, data, fields, timeout)
+            with lock:
+                samples.append((latency, status))
+        finally:
+            in_flight.release()
+
+    start = time.perf_counter()
+    next_at, i = start, 0
+    while next_at - start < duration:
+        time.sleep(max(0.0, next_at - time.perf_counter()))
+        if in_flight.acquire(blocking=False):
+            name, data = corpus[i % len(corpus)]
+            t = threading.Thread(target=fire, args=(name, data))
+            t.start()
+            threads.append(t)
+        else:
+            dropped += 1 # Server saturated: arrival not sent
+        i += 1
+        next_at += rng.expovariate(rate)
+    for t in threads: t.join()
+    return samples, dropped
+
+
+def summarize(samples, elapsed):
+    latencies = np.array([l for l, s in samples]) if samples else np.zeros(1)
+    statuses = {}
+    for _, s in samples:
+        statuses[str(s)] = statuses.get(str(s), 0) + 1
+    errors = sum(n for s, n in statuses.items() if s != "200")
+    return {
+        "requests": len(samples),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(samples) / elapsed, 3) if elapsed else 0.0,
+        "latency_p50_s": round(float(np.percentile(latencies, 50)), 3),
+        "latency_p95_s": round(float(np.percentile(latencies, 95)), 3),
+        "latency_p99_s": round(float(np.percentile(latencies, 99)), 3),
+        "latency_max_s": round(float(latencies.max()), 3),
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "statuses": statuses,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=SRC_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(previous_path, report):
+    with open(previous_path, "r", encoding="utf-8") as f:
+        previous = json.load(f)
+    print(f"\n=== vs {os.path.basename(previous_path)} ({previous.get('revision')}) ===")
+    for key in ("throughput_rps", "latency_p50_s", "latency_p95_s", "latency_p99_s", "error_rate", "peak_rss_mb"):
+        old, new = previous["results"].get(key), report["results"].get(key)
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{key:>16}: {old:>10} -> {new:<10} ({change})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Base URL of a running API (default: start one in-process)")
+    parser.add_argument("--server-pid", type=int, help="PID of the --url server, for RSS sampling")
+    parser.add_argument("--concurrency", type=int, default=4, help="Closed loop: parallel clients")
+    parser.add_argument("--requests", type=int, default=40, help="Closed loop: total uploads")
+    parser.add_argument("--rate", type=float, help="Open loop: mean arrivals per second (Poisson)")
+    parser.add_argument("--duration", type=float, default=60, help="Open loop: seconds of arrivals")
+    parser.add_argument("--max-in-flight", type=int, default=64, help="Open loop: cap on outstanding requests")
+    parser.add_argument("--profile", help="Profile form field sent with each upload")
+    parser.add_argument("--input-dir", default=os.path.join(os.path.dirname(SRC_DIR), "input"))
+    parser.add_argument("--synthetic", type=int, default=4, help="Synthetic reports added to the corpus")
+    parser.add_argument("--timeout", type=float, default=300, help="Per-request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compare", help="Previous report JSON to diff against")
+    parser.add_argument("--label", default="", help="Free-form label stored in the report")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="ocr_loadtest_")
+    corpus = build_corpus(args.input_dir, args.synthetic)
+    if not corpus:
+        print("Empty corpus: add files to input/ or use --synthetic N")
+        return
+    fields = {"profile": args.profile} if args.profile else {}
+
+    if args.url:
+        base_url, pid = args.url.rstrip("/"), args.server_pid
+    else:
+        base_url, _ = start_in_process_server(work_dir)
+        pid = os.getpid()
+    print(f"Target {base_url}, corpus of {len(corpus)} files; waiting for /ready...")
+    if not wait_ready(base_url, timeout=600):
+        print("API did not become ready")
+        return
+
+    mode = {"mode": "open", "rate": args.rate, "duration": args.duration} if args.rate \
+        else {"mode": "closed", "concurrency": args.concurrency, "requests": args.requests}
+    print(f"Running {mode}...")
+    dropped = 0
+    start = time.perf_counter()
+    with (RssSampler(pid) if pid else contextlib.nullcontext()) as sampler:
+        if args.rate:
+            samples, dropped = run_open_loop(base_url, corpus, fields, args.rate, args.duration,
+                                             args.max_in_flight, args.timeout, args.seed)
+        else:
+            samples = run_closed_loop(base_url, corpus, fields, args.concurrency, args.requests, args.timeout)
+    elapsed = time.perf_counter() - start
+
+    results = summarize(samples, elapsed)
+    results["dropped_arrivals"] = dropped
+    results["peak_rss_mb"] = round(sampler.peak / 1024 ** 2, 1) if sampler else None
+    report = {
+        "label": args.label,
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "target": "in-process" if not args.url else base_url,
+        "profile": args.profile,
+        "corpus_files": len(corpus),
+        "load": mode,
+        "results": results,
+    }
+    print(json.dumps(results, indent=2))
+
+    out_dir = os.path.join(OUTPUT_DIR, "benchmarks")
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, f"api_load_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nLoad test saved to: {out_path}")
+
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Load test for the shared inference daemon (src/inference_server.py).
+
+Starts the daemon (or uses a running one with --no-spawn), then C concurrent
+clients each send R single-page OCR requests, the way API workers would.
+Reports pages/s, request latency, the daemon's resident memory and
+throughput per GB of RAM, next to the memory C workers would need if each
+held its own copy of the models (estimated as C x daemon RSS).
+
+Usage:
+    python src/utils/loadtest_inference.py [--clients 4] [--requests 10]
+                                           [--window-ms 0 10 25] [--profile fast]
+
+Pages are rendered synthetic lab-table pages unless --pages points at images.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from OCR_robust import OUTPUT_DIR, PROFILES, get_profile  # noqa: E402
+from inference_server import InferenceClient, RemotePredictor  # noqa: E402
+
+
+def synthetic_page(seed, size=(1754, 1240)):
+    """
+    White A4 page at 150 dpi with a header block and a results table.
+    """
+    import cv2
+    rng = np.random.default_rng(seed)
+    img = np.full(size + (3,), 255, np.uint8)
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    cv2.putText(img, f"Patient Name: TEST PATIENT {seed}", (80, 120), font, 1.0, (0, 0, 0), 2)
+    for x, title in zip((80, 520, 760, 960), ("Test", "Result", "Unit", "Reference Range")):
+        cv2.putText(img, title, (x, 260), font, 0.9, (0, 0, 0), 2)
+    for i, name in enumerate(("Hemoglobin", "WBC", "Platelets", "Glucose", "Creatinine", "ALT", "AST", "Sodium")):
+        y = 320 + i * 60
+        cv2.putText(img, name, (80, y), font, 0.8, (0, 0, 0), 2)
+        cv2.putText(img, f"{rng.uniform(1, 200):.1f}", (520, y), font, 0.8, (0, 0, 0), 2)
+        cv2.putText(img, "mg/dL", (760, y), font, 0.8, (0, 0, 0), 2)
+        cv2.putText(img, "10 - 120", (960, y), font, 0.8, (0, 0, 0), 2)
+    return img
+
+
+def load_pages(paths):
+    import cv2
+    return [cv2.cvtColor(cv2.imread(p), cv2.COLOR_BGR2RGB) for p in paths]
+
+
+def rss_bytes(pid):
+    with open(f"/proc/{pid}/status", "r") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def wait_for_socket(path, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if os.path.exists(path):
+            try:
+                InferenceClient(path).call("stats")
+                return True
+            except ConnectionError:
+                pass
+        time.sleep(0.5)
+    return False
+
+
+def run_load(socket_path, settings, pages, clients, requests):
+    client = InferenceClient(socket_path)
+    predictor = RemotePredictor(client, settings["det_arch"], settings["reco_arch"], settings["detect_orientation"])
+    predictor([pages[0]]) # Warm-up outside the measurement
+
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(k):
+        for r in range(requests):
+            page = pages[(k * requests + r) % len(pages)]
+            start = time.perf_counter()
+            predictor([page])
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(clients)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - start
+    lat = np.array(latencies)
+    return {
+        "pages": len(latencies),
+        "seconds": round(elapsed, 3),
+        "pages_per_s": round(len(latencies) / elapsed, 3),
+        "latency_p50_s": round(float(np.percentile(lat, 50)), 3),
+        "latency_p95_s": round(float(np.percentile(lat, 95)), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=4, help="Concurrent clients (simulated API workers)")
+    parser.add_argument("--requests", type=int, default=10, help="Single-page requests per client")
+    parser.add_argument("--window-ms", type=float, nargs="*", default=[0, 10, 25], help="Batching windows to compare")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="fast")
+    parser.add_argument("--backend", default=None, help="Daemon backend (torch/onnx)")
+    parser.add_argument("--pages", nargs="*", help="Page images to send (default: synthetic pages)")
+    parser.add_argument("--socket", default="/tmp/ocr_loadtest.sock")
+    parser.add_argument("--no-spawn", action="store_true", help="Use a daemon already listening on --socket")
+    args = parser.parse_args()
+
+    _, settings = get_profile(args.profile)
+    pages = load_pages(args.pages) if args.pages else [synthetic_page(i)[:, :, ::-1].copy() for i in range(8)]
+    report = {"profile": args.profile, "clients": args.clients, "requests": args.requests, "runs": []}
+
+    windows = [None] if args.no_spawn else args.window_ms
+    for window in windows:
+        proc = None
+        if not args.no_spawn:
+            cmd = [sys.executable, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inference_server.py"),
+                   "--socket", args.socket, "--window-ms", str(window)]
+            if args.backend:
+                cmd += ["--backend", args.backend]
+            proc = subprocess.Popen(cmd)
+            if not wait_for_socket(args.socket, timeout=300):
+                proc.terminate()
+                print("Inference server did not start")
+                return
+        try:
+            label = "running daemon" if window is None else f"window {window:g} ms"
+            print(f"\n=== {label} ===")
+            result = run_load(args.socket, settings, pages, args.clients, args.requests)
+            pid = InferenceClient(args.socket).call("stats")[0]["pid"]
+            rss_gb = rss_bytes(pid) / 1024 ** 3
+            result.update({
+                "window_ms": window,
+                "daemon_rss_gb": round(rss_gb, 3),
+                "pages_per_s_per_gb": round(result["pages_per_s"] / rss_gb, 3) if rss_gb else None,
+                # Without the daemon every worker holds its own models
+                "per_worker_models_rss_gb_est": round(rss_gb * args.clients, 3),
+            })
+            report["runs"].append(result)
+            print(json.dumps(result, indent=2))
+        finally:
+            if proc:
+                proc.terminate()
+                proc.wait()
+
+    out_dir = os.path.join(OUTPUT_DIR, "benchmarks")
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, f"inference_server_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nLoad test saved to: {out_path}")
+
+
+if __name__ == "__main__":
+    main()